@@ -36,46 +36,48 @@ tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (
 tf.app.flags.DEFINE_bool("debug", False, "Run on a small set of data for debugging.")
 tf.app.flags.DEFINE_bool("augment", True, "Whether or not to expand dataset using data augmentation")
 tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding JPEGs when there is no packed dataset (0: one per core).")
+tf.app.flags.DEFINE_integer("chunk_size", 2048, "Number of test images scored before their answers are written out.")
+tf.app.flags.DEFINE_float("tta_threshold", 0.0, "Adaptive test-time augmentation: score all 10 crops only for images whose center crop confidence is below this (0: always all 10).")
+tf.app.flags.DEFINE_string("tta_gate", "max_prob", "Confidence used by --tta_threshold: max_prob (highest probability) or margin (highest minus second highest).")
 
 FLAGS = tf.app.flags.FLAGS
 
-def process_answers(unprocessed_answers):
-    """
-    Extract file_name and file_number, plus reorganize into a dictionary.
-    """
-    answers = {}
-    for file_path, wnid_prediction in unprocessed_answers:
-        file_name = file_path.split("/")[-1]
-        file_number = int(re.findall(r'\d+', file_name)[0])
-        answers[file_number] = (file_name, wnid_prediction)
-    assert(len(answers) == len(unprocessed_answers))
-    return answers
+def file_number(file_path):
+    return int(re.findall(r'\d+', file_path.split("/")[-1])[0])
 
 
-def generate_answers(sess, model, dataset):
+def generate_answers(sess, model, dataset, f):
     """
     Loop over the dev or test dataset and generate answer.
 
     You must implement this function in order to submit to Leaderboard.
 
+    Images are scored in chunks of FLAGS.chunk_size in file number order, and
+    the answers of every chunk are written to f as soon as it is done.
+
     :param sess: active TF session
     :param model: a built QASystem model
-    :return:
+    :param f: text file the "file_name wnid" lines are written to
+    :return: number of answers written
     """
 
-    test_data = list(zip(dataset["X_test"], dataset["test_image_names"]))
     label_to_wnid = dataset["label_to_wnid"]
+    img_names = dataset["test_image_names"]
+    order = sorted(range(len(img_names)), key=lambda i: file_number(img_names[i]))
+    assert(len(set(file_number(img_names[i]) for i in order)) == len(order))
 
-    #batches, num_batches = get_batches(test_data, FLAGS.batch_size)
-
-    answers = []
-    for img, img_name in tqdm(test_data):
-        img = np.expand_dims(img, axis=0)
-        pred = model.crop_classify(sess, img)
-        answers.append((img_name, label_to_wnid[pred]))
+    num_answers = 0
+    for start in tqdm(range(0, len(order), FLAGS.chunk_size)):
+        chunk = np.array(order[start:start+FLAGS.chunk_size])
+        scores = model.crop_scores(sess, dataset["X_test"][chunk], tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+        for i, pred in zip(chunk, np.argmax(scores, axis=1)):
+            print(img_names[i].split("/")[-1] + " " + label_to_wnid[pred], file=f)
+        f.flush()
+        num_answers += len(chunk)
 
-    print ("Generated {}/{} Answers".format(len(answers), len(test_data)))
-    return process_answers(answers)
+    print ("Generated {}/{} Answers".format(num_answers, len(img_names)))
+    return num_answers
 
 
 def main(_):
@@ -89,9 +91,17 @@ def main(_):
     with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
         json.dump(FLAGS.__flags, fout)
 
+    if FLAGS.train_dir == "":
+        FLAGS.train_dir = pjoin("train", FLAGS.classifier)
+
     # ========= Load Dataset =========
+    normalization = load_normalization(FLAGS.train_dir)
+    if normalization is None:
+        logging.warning("No normalization.npz in %s, recomputing the statistics from the training set" % FLAGS.train_dir)
+        normalization = load_train_stats(FLAGS.data_dir, FLAGS.num_workers).normalization()
+
     print ("Loading Tiny-Imagenet Dataset")
-    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = False, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug)
+    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = False, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug, num_workers=FLAGS.num_workers, normalization=normalization)
 
     #Store img sizes
     jitter = 8
@@ -108,19 +118,13 @@ def main(_):
     model = Model(classifier, FLAGS)
 
     with tf.Session() as sess:
-        if FLAGS.train_dir == "":
-            FLAGS.train_dir = pjoin("train", classifier.name())
         print ("train_dir: ", FLAGS.train_dir)
         initialize_model(sess, model, FLAGS.train_dir)
 
+        # Answers go straight to the file in root dir as they are generated
         print ("Generating Answers")
-        answers = generate_answers(sess, model, dataset)
-
-        # write to json file to root dir
-        print ("Writing to File")
         with io.open(pjoin(FLAGS.train_dir, 'tromero1.txt'), 'w') as f:
-            for _, (file_name, wnid_prediction) in sorted(answers.items()):
-                print(file_name + " " + wnid_prediction, file=f)
+            generate_answers(sess, model, dataset, f)
 
 
 if __name__ == "__main__":
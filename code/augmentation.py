@@ -0,0 +1,137 @@
+"""
+Vectorized data augmentation. Every op works on a whole (N, H, W, C) batch with
+array operations and per-sample random parameters, with no Python loop over images.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+
+
+def random_crop(X_batch, H_target, W_target, out=None):
+    """
+    Crop every image of an (N, H, W, C) batch at its own uniformly random offset.
+    All offsets are drawn together and the crops are gathered with one fancy index
+    into a strided view of every possible window. If out (at least N images of the
+    target size) is given the crops are written there, so the caller can reuse one buffer.
+    """
+    X_batch = np.ascontiguousarray(X_batch)
+    N, h, w, C = X_batch.shape
+    y1 = np.random.randint(0, h - H_target + 1, size=N)
+    x1 = np.random.randint(0, w - W_target + 1, size=N)
+
+    # Each crop row is W_target * C contiguous values, so the gather copies whole rows
+    sN, sH, sW, sC = X_batch.strides
+    windows = np.lib.stride_tricks.as_strided(X_batch, shape=(N, h - H_target + 1, w - W_target + 1, H_target, W_target * C),
+                                              strides=(sN, sH, sW, sH, sC), writeable=False)
+    crops = windows[np.arange(N), y1, x1].reshape(N, H_target, W_target, C)
+    if out is None:
+        return crops
+    out = out[:N]
+    out[...] = crops
+    return out
+
+
+def random_flip(X_batch, p=0.5):
+    """
+    Mirror each image left-right (the W axis of NHWC) independently with probability p.
+    Works in place and returns X_batch.
+    """
+    flip = np.random.rand(X_batch.shape[0]) < p
+    X_batch[flip] = X_batch[flip, :, ::-1]
+    return X_batch
+
+
+def random_brightness_contrast(X_batch, brightness=0.0, contrast=0.0):
+    """
+    Per image, add a brightness offset drawn from [-brightness, brightness] and scale
+    the deviation from the image mean by a factor drawn from [1 - contrast, 1 + contrast].
+    X_batch must be floating point. Works in place and returns X_batch.
+    """
+    N = X_batch.shape[0]
+    if contrast > 0:
+        factor = np.random.uniform(1 - contrast, 1 + contrast, size=(N, 1, 1, 1)).astype(X_batch.dtype)
+        mean = X_batch.mean(axis=(1, 2, 3), keepdims=True)
+        X_batch -= mean
+        X_batch *= factor
+        X_batch += mean
+    if brightness > 0:
+        X_batch += np.random.uniform(-brightness, brightness, size=(N, 1, 1, 1)).astype(X_batch.dtype)
+    return X_batch
+
+
+def random_rotate(X_batch, max_degrees=30.0, fill=0.0):
+    """
+    Rotate each image about its center by its own angle drawn from
+    [-max_degrees, max_degrees], as one batched affine warp with bilinear
+    sampling. Pixels that come from outside the image are fill, 0 like
+    scipy.ndimage.rotate by default; fill can also be an array broadcasting
+    to one image, such as the mean image for raw (not mean-subtracted) images.
+    Returns a new array of the same dtype.
+    """
+    fill = np.asarray(fill, dtype=np.float32)
+    N, H, W, C = X_batch.shape
+    theta = np.deg2rad(np.random.uniform(-max_degrees, max_degrees, size=(N, 1, 1))).astype(np.float32)
+    cos, sin = np.cos(theta), np.sin(theta)
+
+    # For every output pixel, the source position it is rotated from
+    dy, dx = np.mgrid[0:H, 0:W].astype(np.float32)
+    dy -= (H - 1) / 2.0
+    dx -= (W - 1) / 2.0
+    src_y = cos * dy + sin * dx + (H - 1) / 2.0
+    src_x = cos * dx - sin * dy + (W - 1) / 2.0
+
+    y0, x0 = np.floor(src_y), np.floor(src_x)
+    wy, wx = src_y - y0, src_x - x0
+    y0, x0 = y0.astype(np.int64), x0.astype(np.int64)
+
+    # Gather the four neighbours of every source position as rows of the flattened batch
+    X_flat = np.ascontiguousarray(X_batch).reshape(N * H * W, C)
+    base = (np.arange(N) * (H * W))[:, None, None]
+    out = np.zeros((N, H, W, C), dtype=np.float32)
+    for y, x, weight in [(y0, x0, (1 - wy) * (1 - wx)), (y0, x0 + 1, (1 - wy) * wx),
+                         (y0 + 1, x0, wy * (1 - wx)), (y0 + 1, x0 + 1, wy * wx)]:
+        inside = (y >= 0) & (y < H) & (x >= 0) & (x < W)
+        rows = base + np.clip(y, 0, H - 1) * W + np.clip(x, 0, W - 1)
+        out += X_flat.take(rows, axis=0) * (weight * inside)[..., None]
+        if fill.any():
+            out += fill * (weight * ~inside)[..., None]
+
+    if np.issubdtype(X_batch.dtype, np.integer):
+        out = np.rint(out)
+    return out.astype(X_batch.dtype)
+
+
+def benchmark(batch_size=256, iters=50, H=64, W=64, H_target=56, W_target=56):
+    """
+    Prints the throughput of each op on random float32 batches, to compare against
+    the images/sec of a training step.
+    """
+    X = np.random.randn(batch_size, H, W, 3).astype(np.float32)
+    out = np.empty((batch_size, H_target, W_target, 3), dtype=np.float32)
+    crops = random_crop(X, H_target, W_target)
+
+    ops = [
+        ("random_crop", lambda: random_crop(X, H_target, W_target, out)),
+        ("random_flip", lambda: random_flip(crops)),
+        ("random_brightness_contrast", lambda: random_brightness_contrast(crops, 10.0, 0.2)),
+        ("random_rotate", lambda: random_rotate(X)),
+    ]
+    for name, op in ops:
+        op()   # Warm up
+        start = time.time()
+        for _ in range(iters):
+            op()
+        elapsed = time.time() - start
+        print("%-28s %8.2f ms/batch %12.0f images/sec" % (name, 1000 * elapsed / iters, batch_size * iters / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the batched augmentation ops")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--iters", type=int, default=50)
+    args = parser.parse_args()
+
+    benchmark(args.batch_size, args.iters)
@@ -4,12 +4,19 @@ from builtins import range
 from six.moves import cPickle as pickle
 import numpy as np
 import os
+import io
+import copy
+import json
+import multiprocessing
+import zipfile
 from scipy.misc import imread, imsave, imresize
-from scipy.ndimage import gaussian_filter, rotate
+from scipy.ndimage import gaussian_filter
 import platform
 from tqdm import tqdm
 import random
 
+from augmentation import random_crop, random_flip, random_brightness_contrast, random_rotate
+
 def load_pickle(f):
     version = platform.python_version_tuple()
     if version[0] == '2':
@@ -83,7 +90,9 @@ def get_CIFAR10_data(filepath, num_training=49000, num_validation=1000, num_test
     }
 
 
-def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=True, debug=False, debug_nclass=3):
+def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=True, debug=False, debug_nclass=3,
+                       use_packed=True, packed_dir=None, num_workers=1, per_channel=False, normalization=None,
+                       val_only=False):
     """
     Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
     TinyImageNet-200 have the same directory structure, so this can be used
@@ -94,10 +103,26 @@ def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=T
     Inputs:
     - path: String giving path to the directory to load.
     - is_training: If True, dont load testing data, if False, dont load training and val data
-        Note: Must always load training data in order to subtract_mean.
+        Note: Must load training data in order to subtract_mean, unless normalization is given.
     - dtype: numpy datatype used to load the data.
     - subtract_mean: Whether to subtract the mean training image.
+        With an integer dtype (np.uint8) the images are left as they are and only
+        the normalization is returned; apply it per batch with normalize_batch.
     - debug: Whether or not to load a small number of classes for debugging
+    - use_packed: Whether to memory-map the packed cache written by pack_tiny_imagenet
+        instead of decoding the JPEGs, if that cache exists.
+        The memory map is only returned as is for dtype=np.uint8; any other dtype
+        makes a private (normalized) copy of every split that is loaded.
+    - packed_dir: Location of the packed cache (default: <path>/packed)
+    - num_workers: Number of processes decoding JPEGs when there is no packed cache.
+        0 or None uses every core.
+    - per_channel: Normalize with the per-channel mean and std instead of subtracting
+        the mean image.
+    - normalization: Precomputed statistics (see load_normalization). When testing, this
+        means the training images are never decoded.
+    - val_only: With is_training, only load the validation split (X_train and y_train are
+        None). The training images are then only read when the statistics are needed
+        and neither normalization nor a packed stats.npz provides them.
 
     Returns: A dictionary with the following entries:
     - class_names: A list where class_names[i] is a list of strings giving the
@@ -110,73 +135,49 @@ def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=T
     - y_test: (N_test,) array of test labels; if test labels are not available
       (such as in student code) then y_test will be None.
     - mean_image: (64, 64, 3) array giving mean training image
+      (the (3,) channel mean when normalizing per channel)
+    - normalization: dictionary with the 'mean' (and for per_channel the 'std')
+      that were, or for integer datasets should be, applied to the images
     - label_to_wnid: dictionary with mapping from integer class label to wnid
     """
-    # First load wnids
-    with open(os.path.join(path, 'wnids.txt'), 'r') as f:
-        wnids = [x.strip() for x in f]
+    packed_dir = packed_dir or os.path.join(path, 'packed')
+    if use_packed and is_packed(packed_dir):
+        print('loading packed dataset from %s' % packed_dir)
+        return _load_packed(packed_dir, path, is_training, dtype, subtract_mean, debug, debug_nclass,
+                            per_channel, normalization, val_only)
+
+    files = _DirectoryFiles(path)
+    wnids, class_names = _load_wnids(files)
 
     # Map wnids to integer labels
     wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
     label_to_wnid = {v: k for k, v in wnid_to_label.items()}
 
-    # Use words.txt to get names for each class
-    with open(os.path.join(path, 'words.txt'), 'r') as f:
-        wnid_to_words = dict(line.split('\t') for line in f)
-        for wnid, words in wnid_to_words.items():
-            wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
-    class_names = [wnid_to_words[wnid] for wnid in wnids]
-
     if debug:
         print('Debug is on! Only loading %d / %d training classes.'
                   % (debug_nclass, len(wnids)))
 
-    # Next load training data.
-    X_train, y_train = [], []
-    train_wnids = wnids[:debug_nclass] if debug else wnids
-    for i, wnid in tqdm(enumerate(train_wnids), total=len(train_wnids)):
-        # To figure out the filenames we need to open the boxes file
-        boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
-        with open(boxes_file, 'r') as f:
-            filenames = [x.split('\t')[0] for x in f]
-        num_images = len(filenames)
-
-        X_train_block = np.zeros((num_images, 64, 64, 3), dtype=dtype)
-        y_train_block = wnid_to_label[wnid] * \
-                        np.ones(num_images, dtype=np.int64)
-        for j, img_file in enumerate(filenames):
-            img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:   ## grayscale file
-                img.shape = (64, 64, 1)
-            X_train_block[j] = img
-        X_train.append(X_train_block)
-        y_train.append(y_train_block)
-
-    # We need to concatenate all training data
-    X_train = np.concatenate(X_train, axis=0)
-    y_train = np.concatenate(y_train, axis=0)
+    # Next load training data, unless it is only needed for statistics we already have.
+    # Every image is decoded straight into one preallocated array, so there is no per-class concatenate,
+    # and the statistics are accumulated while the images come in. Images that are only decoded for
+    # the statistics are not kept.
+    X_train, y_train = None, None
+    stats = ImageStats()
+    keep_train = is_training and not val_only
+    if keep_train or (subtract_mean and normalization is None):
+        train_wnids = wnids[:debug_nclass] if debug else wnids
+        train_files, y_train = _train_files_and_labels(files, train_wnids, wnid_to_label)
+        X_train = np.zeros((len(train_files), 64, 64, 3), dtype=dtype) if keep_train else None
+        _decode_images(train_files, X_train, num_workers, stats=stats)
 
     # Next load validation data
     X_val, y_val = None, None
     if is_training:
         print('loading validation data')
-        with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-            img_files = []
-            val_wnids = []
-            for line in f:
-                img_file, wnid = line.split('\t')[:2]
-                img_files.append(img_file)
-                val_wnids.append(wnid)
-            num_val = len(img_files)
-            y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-            X_val = np.zeros((num_val, 64, 64, 3), dtype=dtype)
-            for i, img_file in tqdm(enumerate(img_files), total=len(img_files)):
-                img_file = os.path.join(path, 'val', 'images', img_file)
-                img = imread(img_file)
-                if img.ndim == 2:
-                    img.shape = (64, 64, 1)
-                X_val[i] = img
+        img_files, val_wnids = _val_filenames(files)
+        y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+        X_val = np.zeros((len(img_files), 64, 64, 3), dtype=dtype)
+        _decode_images(img_files, X_val, num_workers)
 
     # Next load test images
     # Students won't have test labels, so we need to iterate over files in the
@@ -184,27 +185,23 @@ def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=T
     X_test, test_image_names = None, None
     if not is_training:
         print('loading testing data')
-        img_files = os.listdir(os.path.join(path, 'test', 'images'))
-        X_test = np.zeros((len(img_files), 64, 64, 3), dtype=dtype)
-        test_image_names = ["unk"]*len(img_files)
-        for i, img_file in tqdm(enumerate(img_files), total=len(img_files)):
-            img_file = os.path.join(path, 'test', 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                img.shape = (64, 64, 1)
-            X_test[i] = img
-            test_image_names[i] = img_file
-
-    mean_image = None
+        test_image_names = _test_filenames(files)
+        X_test = np.zeros((len(test_image_names), 64, 64, 3), dtype=dtype)
+        _decode_images(test_image_names, X_test, num_workers)
+
     if subtract_mean:
-        mean_image = X_train.mean(axis=0)
+        if normalization is None:
+            normalization = stats.normalization(per_channel)
         if is_training:
-            X_train -= mean_image[None]
-            X_val -= mean_image[None]
+            if not val_only:
+                _normalize_in_place(X_train, normalization)
+            _normalize_in_place(X_val, normalization)
         else:
-            X_test -= mean_image[None]
+            _normalize_in_place(X_test, normalization)
+    else:
+        normalization = None
 
-    if not is_training:
+    if not is_training or val_only:
         X_train = None
         y_train = None
 
@@ -215,13 +212,556 @@ def load_tiny_imagenet(path, is_training=True, dtype=np.float32, subtract_mean=T
       'X_val': X_val,
       'y_val': y_val,
       'X_test': X_test,
-      'mean_image': mean_image,
+      'mean_image': normalization['mean'] if normalization else None,
+      'normalization': normalization,
       'label_to_wnid': label_to_wnid,
       'test_image_names': test_image_names,
     }
 
 
-def augment(dataset, fliplr = True, cropAndScale = True, doRotation = True, verbose = True):
+class _DirectoryFiles(object):
+    """ The files of an extracted dataset """
+    def __init__(self, path):
+        self.path = path
+
+    def join(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def open_text(self, *parts):
+        return open(self.join(*parts), 'r')
+
+    def listdir(self, *parts):
+        return os.listdir(self.join(*parts))
+
+    def read_bytes(self, name):
+        with open(name, 'rb') as f:
+            return f.read()
+
+    def read_image(self, name):
+        return imread(name)
+
+
+class _ZipFiles(object):
+    """
+    The files of a dataset read straight out of its zip archive (e.g. the downloaded
+    tiny-imagenet-200.zip), so nothing has to be extracted. Every process opens its
+    own handle on the archive, which makes these objects safe to send to workers.
+    """
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self._zip, self._names = None, None
+        wnids_file = [name for name in self.names() if os.path.basename(name) == 'wnids.txt']
+        if not wnids_file:
+            raise ValueError("No wnids.txt in %s" % zip_path)
+        self.root = os.path.dirname(min(wnids_file, key=len))
+
+    def __getstate__(self):
+        # Workers only read members by name: neither the handle nor the name list is sent along
+        state = self.__dict__.copy()
+        state['_zip'], state['_names'] = None, None
+        return state
+
+    @property
+    def zip(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.zip_path, 'r')
+        return self._zip
+
+    def names(self):
+        if self._names is None:
+            self._names = self.zip.namelist()
+        return self._names
+
+    def join(self, *parts):
+        return '/'.join((self.root,) + parts) if self.root else '/'.join(parts)
+
+    def open_text(self, *parts):
+        return io.TextIOWrapper(self.zip.open(self.join(*parts)), encoding='utf-8')
+
+    def listdir(self, *parts):
+        prefix = self.join(*parts) + '/'
+        return [name[len(prefix):] for name in self.names()
+                if name.startswith(prefix) and '/' not in name[len(prefix):] and name != prefix]
+
+    def read_bytes(self, name):
+        return self.zip.read(name)
+
+    def read_image(self, name):
+        return imread(io.BytesIO(self.read_bytes(name)))
+
+
+def dataset_files(path):
+    """ Access to the dataset at path, which is either its directory or a zip archive of it """
+    if not isinstance(path, str):
+        return path
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return _ZipFiles(path)
+    return _DirectoryFiles(path)
+
+
+def _load_wnids(files):
+    """ Returns the list of wnids and the WordNet names of each one """
+    with files.open_text('wnids.txt') as f:
+        wnids = [x.strip() for x in f]
+
+    # Use words.txt to get names for each class
+    with files.open_text('words.txt') as f:
+        wnid_to_words = dict(line.split('\t') for line in f)
+        for wnid, words in wnid_to_words.items():
+            wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
+    class_names = [wnid_to_words[wnid] for wnid in wnids]
+    return wnids, class_names
+
+
+def load_wnids(path):
+    """
+    The wnids and WordNet class names of the dataset at path (its directory, zip
+    archive or packed cache), in label order, without loading any images.
+    """
+    for packed_dir in [path, os.path.join(path, 'packed')]:
+        if os.path.isdir(packed_dir) and is_packed(packed_dir):
+            with open(os.path.join(packed_dir, 'wnids.txt'), 'r') as f:
+                wnids = [x.strip() for x in f if x.strip()]
+            with open(os.path.join(packed_dir, 'class_names.json'), 'r') as f:
+                return wnids, json.load(f)
+    return _load_wnids(dataset_files(path))
+
+
+def load_train_stats(path, num_workers=1):
+    """
+    The ImageStats of the training images of the dataset at path (its directory, zip
+    archive or packed cache): the packed stats.npz when there is one, otherwise they are
+    accumulated while num_workers processes decode the training images, which are not kept.
+    """
+    for packed_dir in [path, os.path.join(path, 'packed')]:
+        stats_file = os.path.join(packed_dir, 'stats.npz')
+        if os.path.isdir(packed_dir) and is_packed(packed_dir) and os.path.exists(stats_file):
+            return ImageStats.load(stats_file)
+
+    files = dataset_files(path)
+    wnids, _ = _load_wnids(files)
+    train_files, _ = _train_files_and_labels(files, wnids, {wnid: i for i, wnid in enumerate(wnids)})
+    stats = ImageStats()
+    _decode_images(train_files, None, num_workers, stats=stats, files=files)
+    return stats
+
+
+def _train_filenames(files, wnid):
+    # To figure out the filenames we need to open the boxes file
+    with files.open_text('train', wnid, '%s_boxes.txt' % wnid) as f:
+        filenames = [x.split('\t')[0] for x in f]
+    return [files.join('train', wnid, 'images', img_file) for img_file in filenames]
+
+
+def _train_files_and_labels(files, wnids, wnid_to_label):
+    train_files, y_train = [], []
+    for wnid in wnids:
+        filenames = _train_filenames(files, wnid)
+        train_files.extend(filenames)
+        y_train.extend([wnid_to_label[wnid]] * len(filenames))
+    return train_files, np.array(y_train, dtype=np.int64)
+
+
+def _val_filenames(files):
+    with files.open_text('val', 'val_annotations.txt') as f:
+        img_files = []
+        val_wnids = []
+        for line in f:
+            img_file, wnid = line.split('\t')[:2]
+            img_files.append(files.join('val', 'images', img_file))
+            val_wnids.append(wnid)
+    return img_files, val_wnids
+
+
+def _test_filenames(files):
+    img_files = files.listdir('test', 'images')
+    return [files.join('test', 'images', img_file) for img_file in img_files]
+
+
+def _load_image(img_file, files=None):
+    img = files.read_image(img_file) if files else imread(img_file)
+    if img.ndim == 2:   ## grayscale file, broadcasts over the color channels
+        img.shape = (64, 64, 1)
+    return img
+
+
+def decode_image(data, size=64):
+    """
+    Decode an encoded (JPEG, PNG, ...) image to a (size, size, 3) uint8 array.
+    Grayscale images are repeated over the color channels, an alpha channel is
+    dropped and images of another size are resized.
+    """
+    img = imread(io.BytesIO(data))
+    if img.ndim == 2:
+        img = np.repeat(img[:, :, None], 3, axis=2)
+    img = img[:, :, :3]
+    if img.shape[:2] != (size, size):
+        img = imresize(img, (size, size))
+    return img.astype(np.uint8)
+
+
+_worker_files = [None]
+
+def _init_decode_worker(files):
+    # Every worker keeps one files object, and so opens a zip archive only once. The copy
+    # drops an archive handle inherited from the parent (see _ZipFiles.__getstate__)
+    _worker_files[0] = copy.copy(files)
+
+
+def _decode_chunk(chunk, files=None):
+    start, img_files, with_stats = chunk
+    files = files if files is not None else _worker_files[0]
+    X = np.zeros((len(img_files), 64, 64, 3), dtype=np.uint8)
+    for i, img_file in enumerate(img_files):
+        X[i] = _load_image(img_file, files)
+    # The statistics of the chunk are computed by the worker too, the parent only merges them
+    stats = None
+    if with_stats:
+        stats = ImageStats(X.shape[1:])
+        stats.update(X)
+    return start, X, stats
+
+
+def _decode_images(img_files, out, num_workers=1, chunk_size=256, stats=None, files=None):
+    """
+    Decode img_files into the preallocated array out (which may be memory-mapped).
+    With num_workers > 1 the files are split into chunks that a process pool decodes,
+    and each chunk is copied into its slot of out as soon as it arrives, so peak memory
+    is out plus a few in-flight chunks. 0 or None uses every core.
+    If stats (an ImageStats) is given, the statistics of every decoded chunk (computed
+    by the workers) are merged into it; out can then be None to only compute the statistics.
+    files (see dataset_files) reads the images from somewhere other than plain paths.
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    chunks = [(start, img_files[start:start + chunk_size], stats is not None) for start in range(0, len(img_files), chunk_size)]
+
+    pool = multiprocessing.Pool(num_workers, _init_decode_worker, (files,)) if num_workers > 1 else None
+    decoded = pool.imap_unordered(_decode_chunk, chunks) if pool else (_decode_chunk(chunk, files) for chunk in chunks)
+    try:
+        with tqdm(total=len(img_files)) as progress:
+            for start, X, chunk_stats in decoded:
+                if out is not None:
+                    out[start:start + X.shape[0]] = X
+                if stats is not None:
+                    stats.merge(chunk_stats)
+                progress.update(X.shape[0])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return out
+
+
+################################################################################################################################
+# Packed cache: one contiguous uint8 .npy file per split that load_tiny_imagenet memory-maps
+
+def is_packed(packed_dir):
+    # mean_image.npy is written last, so a pack that was interrupted is never picked up
+    return os.path.exists(os.path.join(packed_dir, 'mean_image.npy'))
+
+
+def pack_tiny_imagenet(path, packed_dir=None, num_workers=1):
+    """
+    Decode every TinyImageNet image once and write the splits to packed_dir
+    (default: <path>/packed) as uint8 .npy files, together with the labels,
+    wnids, class names and the training set statistics. Images are decoded straight
+    into the memory-mapped output files, so packing never holds a whole split in RAM.
+    num_workers processes share the decoding (0 or None uses every core).
+    path can also be the downloaded zip file, in which case the images are read
+    straight out of the archive and packed_dir must be given.
+    """
+    files = dataset_files(path)
+    if packed_dir is None:
+        assert os.path.isdir(path), "packed_dir is required when packing from a zip file"
+        packed_dir = os.path.join(path, 'packed')
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+
+    wnids, class_names = _load_wnids(files)
+    wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
+    with open(os.path.join(packed_dir, 'wnids.txt'), 'w') as f:
+        f.write('\n'.join(wnids) + '\n')
+    with open(os.path.join(packed_dir, 'class_names.json'), 'w') as f:
+        json.dump(class_names, f)
+
+    print('packing training data')
+    train_files, y_train = _train_files_and_labels(files, wnids, wnid_to_label)
+    stats = ImageStats()
+    _pack_images(train_files, os.path.join(packed_dir, 'X_train.npy'), num_workers, stats, files)
+    np.save(os.path.join(packed_dir, 'y_train.npy'), y_train)
+
+    print('packing validation data')
+    val_files, val_wnids = _val_filenames(files)
+    _pack_images(val_files, os.path.join(packed_dir, 'X_val.npy'), num_workers, files=files)
+    np.save(os.path.join(packed_dir, 'y_val.npy'), np.array([wnid_to_label[w] for w in val_wnids], dtype=np.int64))
+
+    print('packing testing data')
+    test_files = _test_filenames(files)
+    _pack_images(test_files, os.path.join(packed_dir, 'X_test.npy'), num_workers, files=files)
+    with open(os.path.join(packed_dir, 'test_image_names.txt'), 'w') as f:
+        f.write('\n'.join(os.path.basename(img_file) for img_file in test_files) + '\n')
+
+    stats.save(os.path.join(packed_dir, 'stats.npz'))
+    np.save(os.path.join(packed_dir, 'mean_image.npy'), stats.mean_image)
+    print('Packed dataset written to %s' % packed_dir)
+    return packed_dir
+
+
+def _pack_images(img_files, filename, num_workers=1, stats=None, files=None):
+    X = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=(len(img_files), 64, 64, 3))
+    _decode_images(img_files, X, num_workers, stats=stats, files=files)
+    X.flush()
+    return X
+
+
+class ImageStats(object):
+    """
+    Streaming per-pixel and per-channel mean and std of a set of images.
+
+    Batches (or shards) are folded in one at a time with the pairwise update of
+    Chan et al., accumulating in float64, so memory does not depend on the
+    number of images and partial results from separate readers can be merged.
+    """
+    def __init__(self, shape=(64, 64, 3)):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)   # Sum of squared deviations from the mean
+
+    @classmethod
+    def from_array(cls, X, chunk_size=10000):
+        # Reads a chunk at a time, so a memory-mapped split is never fully converted
+        stats = cls(X.shape[1:])
+        for start in range(0, X.shape[0], chunk_size):
+            stats.update(X[start:start + chunk_size])
+        return stats
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            stats = cls(f['mean'].shape)
+            stats.count, stats.mean, stats.m2 = int(f['count']), f['mean'], f['m2']
+        return stats
+
+    def save(self, filename):
+        np.savez(filename, count=self.count, mean=self.mean, m2=self.m2)
+
+    def update(self, X_batch):
+        X_batch = np.asarray(X_batch, dtype=np.float64)
+        if X_batch.shape[0] == 0:
+            return
+        batch_mean = X_batch.mean(axis=0)
+        batch_m2 = np.square(X_batch - batch_mean).sum(axis=0)
+        self._combine(X_batch.shape[0], batch_mean, batch_m2)
+
+    def merge(self, other):
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / float(total))
+        self.m2 = self.m2 + m2 + np.square(delta) * (self.count * count / float(total))
+        self.count = total
+
+    @property
+    def mean_image(self):
+        return self.mean.astype(np.float32)
+
+    @property
+    def std_image(self):
+        return np.sqrt(self.m2 / self.count).astype(np.float32)
+
+    @property
+    def channel_mean(self):
+        # Every pixel saw the same number of images, so this is the mean of the pixel means
+        return self.mean.mean(axis=(0, 1)).astype(np.float32)
+
+    @property
+    def channel_std(self):
+        # Law of total variance over the pixel positions
+        var = (self.m2 / self.count + np.square(self.mean - self.mean.mean(axis=(0, 1)))).mean(axis=(0, 1))
+        return np.sqrt(var).astype(np.float32)
+
+    def normalization(self, per_channel=False):
+        """
+        The statistics to normalize with: the mean image, or with per_channel the
+        channel mean and std. See normalize_batch.
+        """
+        if per_channel:
+            return {'mean': self.channel_mean, 'std': self.channel_std}
+        return {'mean': self.mean_image}
+
+
+def _normalize_in_place(X, normalization):
+    # Integer datasets stay raw and are normalized per batch instead
+    if not np.issubdtype(X.dtype, np.integer):
+        X -= normalization['mean']
+        if 'std' in normalization:
+            X /= normalization['std']
+
+
+def normalize_batch(X_batch, normalization):
+    """
+    Convert a batch of raw images (e.g. uint8 from load_tiny_imagenet(dtype=np.uint8))
+    to float32 and subtract the mean (and divide by the std when normalizing per
+    channel). Only the batch is ever converted, so the dataset itself can stay uint8
+    (or memory-mapped) at a quarter of the float32 size.
+    """
+    X_batch = np.array(X_batch, dtype=np.float32)
+    _normalize_in_place(X_batch, normalization)
+    return X_batch
+
+
+def save_normalization(directory, normalization):
+    """
+    Store the normalization statistics next to a checkpoint, so inference does not
+    have to load the training set to recompute them.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    np.savez(os.path.join(directory, 'normalization.npz'), **normalization)
+
+
+def load_normalization(directory):
+    """
+    Returns the normalization saved by save_normalization in directory or its parent
+    (snapshot folders share their run's statistics), or None if there is none.
+    """
+    for d in [directory, os.path.dirname(os.path.normpath(directory))]:
+        filename = os.path.join(d, 'normalization.npz')
+        if os.path.exists(filename):
+            with np.load(filename) as f:
+                return {k: f[k] for k in f.files}
+    return None
+
+
+def _load_packed(packed_dir, path, is_training, dtype, subtract_mean, debug, debug_nclass,
+                 per_channel=False, normalization=None, val_only=False):
+    with open(os.path.join(packed_dir, 'wnids.txt'), 'r') as f:
+        wnids = [x.strip() for x in f if x.strip()]
+    with open(os.path.join(packed_dir, 'class_names.json'), 'r') as f:
+        class_names = json.load(f)
+    label_to_wnid = {i: wnid for i, wnid in enumerate(wnids)}
+
+    def load(name):
+        # Converting to another dtype copies the split out of the page cache
+        X = np.load(os.path.join(packed_dir, name), mmap_mode='r')
+        return X if X.dtype == dtype else X.astype(dtype)
+
+    y_train = np.load(os.path.join(packed_dir, 'y_train.npy'))
+    X_train = np.load(os.path.join(packed_dir, 'X_train.npy'), mmap_mode='r')
+    if debug:
+        print('Debug is on! Only loading %d / %d training classes.'
+                  % (debug_nclass, len(wnids)))
+        # Training images are packed in label order
+        num_train = np.searchsorted(y_train, debug_nclass)
+        X_train, y_train = X_train[:num_train], y_train[:num_train]
+    if subtract_mean and normalization is None:
+        stats_file = os.path.join(packed_dir, 'stats.npz')
+        if debug or not os.path.exists(stats_file):
+            stats = ImageStats.from_array(X_train)
+        else:
+            stats = ImageStats.load(stats_file)
+        normalization = stats.normalization(per_channel)
+
+    X_val, y_val, X_test, test_image_names = None, None, None, None
+    if is_training and val_only:
+        X_train, y_train = None, None
+        X_val = load('X_val.npy')
+        y_val = np.load(os.path.join(packed_dir, 'y_val.npy'))
+    elif is_training:
+        X_train = X_train if X_train.dtype == dtype else X_train.astype(dtype)
+        X_val = load('X_val.npy')
+        y_val = np.load(os.path.join(packed_dir, 'y_val.npy'))
+    else:
+        X_train, y_train = None, None
+        X_test = load('X_test.npy')
+        with open(os.path.join(packed_dir, 'test_image_names.txt'), 'r') as f:
+            test_image_names = [os.path.join(path, 'test', 'images', x.strip()) for x in f if x.strip()]
+
+    if subtract_mean:
+        if is_training:
+            if X_train is not None:
+                _normalize_in_place(X_train, normalization)
+            _normalize_in_place(X_val, normalization)
+        else:
+            _normalize_in_place(X_test, normalization)
+    else:
+        normalization = None
+
+    return {
+      'class_names': class_names,
+      'X_train': X_train,
+      'y_train': y_train,
+      'X_val': X_val,
+      'y_val': y_val,
+      'X_test': X_test,
+      'mean_image': normalization['mean'] if normalization else None,
+      'normalization': normalization,
+      'label_to_wnid': label_to_wnid,
+      'test_image_names': test_image_names,
+    }
+
+
+class AugmentedImages(object):
+    """
+    Lazy view of X expanded with rotated and/or left-right flipped copies of
+    every image. It has the length and indexing of the concatenated array
+    augment() used to build (originals first, then rotated, then the flipped
+    copies of both), but a variant is only produced when it is indexed, so the
+    training set stays at its original size in memory.
+
+    Rotated images get a fresh random angle every time they are requested.
+    The corners they expose are filled with fill (see augmentation.random_rotate).
+    """
+
+    def __init__(self, X, rotate=True, fliplr=True, max_degrees=30.0, fill=0.0):
+        self.X = X
+        self.fill = fill
+        self.rotate = rotate
+        self.fliplr = fliplr
+        self.max_degrees = max_degrees
+        self.factor = (2 if rotate else 1) * (2 if fliplr else 1)
+        self.shape = (len(X) * self.factor,) + tuple(X.shape[1:])
+        self.dtype = X.dtype
+        self.ndim = X.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self[np.array([idx])][0]
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx, dtype=np.int64)
+        idx = np.where(idx < 0, idx + len(self), idx)
+        if idx.size and (idx.min() < 0 or idx.max() >= len(self)):
+            raise IndexError("index out of range for %d images" % len(self))
+
+        N = len(self.X)
+        base, variant = idx % N, idx // N
+        order = np.argsort(base, kind='mergesort')   # Read the base array in order
+        images = np.empty((len(idx),) + self.shape[1:], dtype=self.dtype)
+        images[order] = self.X[base[order]]
+
+        if self.rotate:
+            rotated = (variant % 2) == 1
+            if rotated.any():
+                images[rotated] = random_rotate(images[rotated], self.max_degrees, self.fill)
+        if self.fliplr:
+            flipped = variant >= self.factor // 2
+            images[flipped] = images[flipped, :, ::-1]
+        return images
+
+
+def augment(dataset, fliplr = True, cropAndScale = True, doRotation = True, verbose = True, lazy = False):
+    """
+    Expand the training set with a rotated copy of every image and then a
+    left-right flipped copy of everything. With lazy=True, X_train becomes an
+    AugmentedImages view and the copies are produced batch by batch.
+    """
     X_train = dataset['X_train']
     y_train = dataset['y_train']    
 
@@ -245,24 +785,25 @@ def augment(dataset, fliplr = True, cropAndScale = True, doRotation = True, verb
         y_train = np.concatenate([y_train, y_train], axis=0)
     '''
 
-    if doRotation:
-        N = X_train.shape[0]
-        
-        X_train_list = np.split(X_train , N)
-        X_train_rotated = []
-        for img in X_train_list:
-            degree = (np.random.rand(1) - 0.5) * 60   # Generate random numbers between 30 and -30
-            img_rotated = rotate(img, angle = degree, axes = (1, 2), reshape = False)
-            X_train_rotated.append(img_rotated)
-        X_train_rotated = np.concatenate(X_train_rotated, axis=0)
-
-        X_train = np.concatenate([X_train, X_train_rotated], axis=0)
-        y_train = np.concatenate([y_train, y_train], axis=0)
-
-    if fliplr:
-        X_train_flipped = np.fliplr(X_train)
-        X_train = np.concatenate([X_train, X_train_flipped], axis=0)
-        y_train = np.concatenate([y_train, y_train], axis=0)
+    # Mean-subtracted images are filled with 0 where rotation exposes the corners; raw
+    # (integer) images get the training mean instead, so both come out as the mean
+    fill = 0.0
+    if np.issubdtype(X_train.dtype, np.integer) and dataset.get('normalization') is not None:
+        fill = dataset['normalization']['mean']
+
+    if lazy:
+        X_train = AugmentedImages(X_train, rotate=doRotation, fliplr=fliplr, fill=fill)
+        y_train = np.tile(y_train, X_train.factor)
+    else:
+        if doRotation:
+            X_train_rotated = np.concatenate([random_rotate(X_train[i:i+256], fill=fill) for i in range(0, len(X_train), 256)], axis=0)
+            X_train = np.concatenate([X_train, X_train_rotated], axis=0)
+            y_train = np.concatenate([y_train, y_train], axis=0)
+
+        if fliplr:
+            X_train_flipped = X_train[:, :, ::-1]
+            X_train = np.concatenate([X_train, X_train_flipped], axis=0)
+            y_train = np.concatenate([y_train, y_train], axis=0)
 
     dataset['X_train'] = X_train
     dataset['y_train'] = y_train
@@ -275,16 +816,16 @@ def augment(dataset, fliplr = True, cropAndScale = True, doRotation = True, verb
 
 
 # Random crops and reflection
-def augment_batch(X_batch, H_target, W_target):
-    X_batch_scaled = []
-    for img in X_batch:
-        X_batch_scaled.append(scale_and_crop_single_img(img, H_target, W_target))
-
-    X_batch = np.stack(X_batch_scaled, axis=0)   # Make into one numpy array
-
-    if random.random() > 0.5:   # 50-50 chance the batch is flipped
-        X_batch = np.fliplr(X_batch)
-
+def augment_batch(X_batch, H_target, W_target, out=None, brightness=0.0, contrast=0.0):
+    """
+    Random crop, independent left-right flip and optional brightness/contrast jitter
+    for every image of the batch (see augmentation.py). The result is written into
+    out if that buffer is given.
+    """
+    X_batch = random_crop(X_batch, H_target, W_target, out)
+    X_batch = random_flip(X_batch)
+    if brightness > 0 or contrast > 0:
+        X_batch = random_brightness_contrast(X_batch, brightness, contrast)
     return X_batch
 
 
@@ -311,26 +852,44 @@ def scale_and_crop_single_img(img, H_target, W_target):
 
 
 # Get ten crops of the image
-def crop_10(image, H2, W2):
-    _, H1, W1, C1 = image.shape
-
-    image_flipped = np.fliplr(image)
-    image = np.concatenate([image, image_flipped], axis=0)
+def crop_10_views(image, H2, W2):
+    """
+    The four corner crops and the center crop of every image of the (N, H, W, C)
+    batch, followed each time by the same crop of the left-right flipped batch.
+    Returns 10 (N, H2, W2, C) views of image, nothing is copied.
+    """
+    N, H1, W1, C1 = image.shape
+    image_flipped = image[:, :, ::-1, :]
 
     gapH = H1 - H2
     gapW = W1 - W2
     halfGapH = gapH // 2
     halfGapW = gapW // 2
 
-    ul = image[:, :H2, :W2, :]   # Upper Left
-    br = image[:, gapH:, gapW:, :]   # Bottom Right
-    ur = image[:, :H2, gapW:, :]   # Upper Right
-    bl = image[:, gapW:, :W2, :]   # Bottom Left
-    c = image[:, halfGapH:-halfGapH, halfGapW:-halfGapW, :]   # Center
+    views = []
+    for top, left in [(0, 0),                   # Upper Left
+                      (gapH, gapW),             # Bottom Right
+                      (0, gapW),                # Upper Right
+                      (gapH, 0),                # Bottom Left
+                      (halfGapH, halfGapW)]:    # Center
+        for img in (image, image_flipped):
+            views.append(img[:, top:top+H2, left:left+W2, :])
+    return views
+
 
-    X_train = np.concatenate([ul, br, ur, bl, c], axis=0)
-    assert(X_train.shape == (10, H2, W2, C1))
-    return X_train
+def crop_10(image, H2, W2, out=None):
+    """
+    The crops of crop_10_views stacked into one (10 * N, H2, W2, C) array (or into
+    out, which must have that shape). Crop k of image n is at k * N + n, so
+    scores.reshape(10, N, -1).mean(axis=0) averages the crops of each image.
+    """
+    N, _, _, C1 = image.shape
+    if out is None:
+        out = np.empty((10 * N, H2, W2, C1), dtype=image.dtype)
+    assert(out.shape == (10 * N, H2, W2, C1))
+    for k, view in enumerate(crop_10_views(image, H2, W2)):
+        out[k*N:(k+1)*N] = view
+    return out
 
 
     
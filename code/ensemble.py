@@ -1,5 +1,7 @@
 import io
 import os
+import math
+import multiprocessing
 import json
 import sys
 import random
@@ -14,10 +16,12 @@ from six.moves import xrange
 import tensorflow as tf
 
 from preprocessing.maybe_download import maybe_download
-from ti_model import Model
+from ti_model import Model, EnsembleModel
 from ti_classifiers import get_classifier
 from utils import *
 from data_utils import *
+from score_cache import ScoreCache, split_name
+from ensemble_select import greedy_selection, member_weights, smallest_ensemble, fit_weights, weighted_scores, accuracy, selection_report, hard_vote
 
 import logging
 
@@ -37,49 +41,72 @@ tf.app.flags.DEFINE_string("data_dir", "data/tiny-imagenet-200", "tiny-imagenet
 tf.app.flags.DEFINE_bool("debug", False, "Run on a small set of data for debugging.")
 tf.app.flags.DEFINE_bool("augment", True, "Whether or not to expand dataset using data augmentation")
 tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
-
-tf.app.flags.DEFINE_string("method", "soft", "Majority Vote (hard) or Average Probabilities (soft)")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding JPEGs when there is no packed dataset (0: one per core).")
+tf.app.flags.DEFINE_float("tta_threshold", 0.0, "Adaptive test-time augmentation: score all 10 crops only for images whose center crop confidence is below this (0: always all 10).")
+tf.app.flags.DEFINE_string("tta_gate", "max_prob", "Confidence used by --tta_threshold: max_prob (highest probability) or margin (highest minus second highest).")
+
+tf.app.flags.DEFINE_string("method", "soft", "Majority Vote (hard), Average Probabilities (soft) or a weighted average of greedily selected snapshots (greedy)")
+tf.app.flags.DEFINE_string("score_cache", "score_cache", "Directory keeping every snapshot's scores, so only new snapshots or images are scored (default: ./score_cache)")
+tf.app.flags.DEFINE_bool("score_val", False, "Also score (and cache) the validation set with every snapshot")
+tf.app.flags.DEFINE_string("vote_priority", "", "hard: comma separated answer files (snapshot folders with --vote_scores) that win ties, in order (the others follow sorted by name)")
+tf.app.flags.DEFINE_bool("vote_scores", False, "hard: vote with the top-1 class of every snapshot's (cached) test scores instead of answer files")
+tf.app.flags.DEFINE_float("target_acc", 0.0, "greedy: ship the fewest snapshots reaching this validation accuracy (0: the most accurate selection)")
+tf.app.flags.DEFINE_integer("max_members", 0, "greedy: number of selection steps, snapshots can be picked repeatedly (0: twice the number of snapshots)")
+tf.app.flags.DEFINE_bool("single_graph", False, "Score the test set with all (selected) snapshots in one graph, one session.run per batch, instead of one snapshot at a time")
+tf.app.flags.DEFINE_integer("score_workers", 1, "Processes scoring snapshots (or shards of their images) in parallel, each with its own graph and session (0: one per core, 1: score in this process)")
+tf.app.flags.DEFINE_integer("score_threads", 0, "TensorFlow threads per scoring process (0: cores / score_workers)")
+tf.app.flags.DEFINE_bool("fit_weights", False, "greedy: refine the member weights by minimizing the validation log loss")
 
 FLAGS = tf.app.flags.FLAGS
 
 
 def majority_vote():
     # If using majority vote, specifiy train_dir as a directory with the previously generated .txt answer files
-    # Put the file you want as the default to break ties first
+    # Ties go to the files in --vote_priority first, then to the other files sorted by name
     print ("Using Majority Vote")
+    if FLAGS.vote_scores:
+        return score_vote()
+
     os.chdir(FLAGS.train_dir)
-    files = glob.glob('./*.txt')
+    files = sorted(glob.glob('./*.txt'))
+    priority = [os.path.join('.', os.path.basename(fname)) for fname in FLAGS.vote_priority.split(",") if fname]
+    files = [fname for fname in priority if fname in files] + [fname for fname in files if fname not in priority]
     print(files)
 
     print ("Reading in answers")
-    d = defaultdict(list)
-    ensemble_answers = {}
+    wnid_to_int, image_to_int = {}, {}
+    answers = []
     for fname in files:
         with open(fname) as f:
-            content = f.readlines()
-            content = [x.strip() for x in content]
-            for line in content:
-                file_name, class_name = tuple(line.split())
-                d[file_name].append(class_name)
+            pairs = [line.split() for line in f if line.strip()]
+        images = np.array([image_to_int.setdefault(file_name, len(image_to_int)) for file_name, _ in pairs], dtype=np.int64)
+        classes = np.array([wnid_to_int.setdefault(class_name, len(wnid_to_int)) for _, class_name in pairs], dtype=np.int64)
+        answers.append((images, classes))
+
+    # (n_models, n_images) matrix of votes, -1 where a file has no answer for an image
+    labels = np.full((len(files), len(image_to_int)), -1, dtype=np.int64)
+    for m, (images, classes) in enumerate(answers):
+        labels[m, images] = classes
 
     print ("Determining Answers")
-    for fname, answers in d.items():
-        answer = max(answers, key = answers.count)
-        ensemble_answers[fname] = answer
+    winners = hard_vote(labels, len(wnid_to_int))
+    int_to_wnid = {i: wnid for wnid, i in wnid_to_int.items()}
+    ensemble_answers = process_answers({file_name: int_to_wnid[winners[i]] for file_name, i in image_to_int.items()})
 
     print ("Writing to File")
-    if not os.path.exists("mv_ensemble"):
-        os.makedirs("mv_ensemble")
+    write_answers("mv_ensemble", ensemble_answers)
 
-    with open(pjoin("mv_ensemble", 'tromero1.txt'), 'w') as f:
-        for fname, answer in ensemble_answers.items():
-            print(fname + " " + answer, file=f)
 
+def load_test_set():
+    """ The test set, normalized with the statistics saved with the snapshots, and the image sizes in FLAGS """
+    # Snapshots of one run share the normalization saved at training time
+    normalization = load_normalization(FLAGS.train_dir)
+    if normalization is None:
+        logging.warning("No normalization.npz in %s, recomputing the statistics from the training set" % FLAGS.train_dir)
+        normalization = load_train_stats(FLAGS.data_dir, FLAGS.num_workers).normalization()
 
-def average_prob():
     print ("Loading Tiny-Imagenet Dataset")
-    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = False, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug)
-    label_to_wnid = dataset["label_to_wnid"]
+    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = False, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug, num_workers=FLAGS.num_workers, normalization=normalization)
 
     #Store img sizes
     jitter = 8
@@ -87,47 +114,93 @@ def average_prob():
     FLAGS.img_W = dataset["X_test"].shape[2] - jitter
     FLAGS.img_C = dataset["X_test"].shape[3]
     print ("Imgs are (" + str(FLAGS.img_H) + ", " + str(FLAGS.img_W) + ", " + str(FLAGS.img_C) + ")")
+    return dataset
+
+
+def write_answers(out_dir, answers):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with io.open(pjoin(out_dir, 'tromero1.txt'), 'w') as f:
+        for _, (file_name, wnid_prediction) in sorted(answers.items()):
+            print(file_name + " " + wnid_prediction, file=f)
+
+
+def score_vote():
+    """ Majority vote of the snapshots' top-1 classes, from their (cached) test scores """
+    dataset = load_test_set()
+    cache = ScoreCache(FLAGS.score_cache)
 
     # ========= Model-specific =========
     os.chdir(FLAGS.train_dir)
-    folders = glob.glob("./*/")
-    print(folders)
+    checkpoints = snapshot_checkpoints(glob.glob("./*/"))
+    # Ties go to the folders in --vote_priority first, then to the other snapshots sorted by name
+    priority = [os.path.basename(os.path.normpath(folder)) for folder in FLAGS.vote_priority.split(",") if folder]
+    def rank(checkpoint):
+        name = os.path.basename(os.path.normpath(checkpoint[0]))
+        return priority.index(name) if name in priority else len(priority)
+    checkpoints = sorted(checkpoints, key=rank)
 
-    print ("Creating '" + FLAGS.classifier + "'")
-    classifier = get_classifier(FLAGS.classifier, FLAGS)
+    test_names = [img_name.split("/")[-1] for img_name in dataset["test_image_names"]]
+    all_scores = snapshot_scores(cache, checkpoints, "test", dataset["X_test"], test_names)
 
-    print ("Creating Model")
-    model = Model(classifier, FLAGS)
+    print ("Determining Answers")
+    winners = hard_vote(np.argmax(all_scores, axis = 2), all_scores.shape[2])
+    label_to_wnid = dataset["label_to_wnid"]
+    answers = process_answers({img_file: label_to_wnid[pred] for img_file, pred in zip(test_names, winners)})
 
-    # Generate scores for each model
-    all_scores = []
-    for i, folder in enumerate(folders):
-        with tf.Session() as sess:
-            print ("model dir: ", folder)
-            initialize_model(sess, model, folder)
+    print ("Writing to File")
+    write_answers("mv_ensemble", answers)
 
-            print ("Generating Scores")
-            scores = generate_scores(sess, model, dataset)
-            all_scores.append(scores)
 
-    # Average of scores for each model
-    answers = {}
-    for img_file in all_scores[0]:
-        scores = [scores_dict[img_file] for scores_dict in all_scores]
-        scores = np.mean(np.stack(scores), axis = 0)
-        pred = np.argmax(scores)
-        answers[img_file] = label_to_wnid[pred]
+def average_prob():
+    dataset = load_test_set()
+    label_to_wnid = dataset["label_to_wnid"]
+
+    val_dataset = None
+    if FLAGS.score_val or FLAGS.method == "greedy":
+        # Only the validation split; data_dir may be relative, so this happens before the chdir below
+        print ("Loading Tiny-Imagenet Validation Set")
+        val_dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = True, val_only = True, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug, num_workers=FLAGS.num_workers, normalization=dataset["normalization"])
+
+    cache = ScoreCache(FLAGS.score_cache)
+
+    # ========= Model-specific =========
+    os.chdir(FLAGS.train_dir)
+    checkpoints = snapshot_checkpoints(glob.glob("./*/"))
+
+    weights = np.full(len(checkpoints), 1.0 / len(checkpoints))
+    if val_dataset is not None:
+        # Validation images are named by their position in val_annotations.txt
+        val_names = ["val_%d" % i for i in range(len(val_dataset["y_val"]))]
+        val_scores = snapshot_scores(cache, checkpoints, "val", val_dataset["X_val"], val_names)
+        print ("Validation accuracy of the plain average: %f" % accuracy(np.mean(val_scores, axis = 0), val_dataset["y_val"]))
+
+        if FLAGS.method == "greedy":
+            weights = select_members(val_scores, val_dataset["y_val"], [folder for folder, _ in checkpoints])
+
+    # Weighted average of scores for each model, only the selected ones are run on the test set
+    test_names = [img_name.split("/")[-1] for img_name in dataset["test_image_names"]]
+    members = np.flatnonzero(weights)
+    member_checkpoints = [checkpoints[i] for i in members]
+    if FLAGS.single_graph:
+        test_scores = ensemble_scores(member_checkpoints, weights[members], dataset["X_test"])
+    else:
+        # Generate (or look up) scores for each model
+        test_scores = weighted_scores(snapshot_scores(cache, member_checkpoints, "test", dataset["X_test"], test_names), weights[members])
+    preds = np.argmax(test_scores, axis = 1)
+    answers = {img_file: label_to_wnid[pred] for img_file, pred in zip(test_names, preds)}
 
     answers = process_answers(answers)
 
     # write to json file to root dir
     print ("Writing to File")
-    if not os.path.exists("wap_ensemble"):
-        os.makedirs("wap_ensemble")
-    
-    with io.open(pjoin("wap_ensemble", 'tromero1.txt'), 'w') as f:
-        for _, (file_name, wnid_prediction) in sorted(answers.items()):
-            print(file_name + " " + wnid_prediction, file=f)
+    out_dir = "greedy_ensemble" if FLAGS.method == "greedy" else "wap_ensemble"
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if FLAGS.method == "greedy":
+        with io.open(pjoin(out_dir, 'members.json'), 'w') as f:
+            f.write(json.dumps({folder: w for (folder, _), w in zip(checkpoints, weights) if w > 0}, indent=1))
+    write_answers(out_dir, answers)
 
 
 def process_answers(unprocessed_answers):
@@ -142,18 +215,186 @@ def process_answers(unprocessed_answers):
     return answers
 
 
-def generate_scores(sess, model, dataset):
-    test_data = list(zip(dataset["X_test"], dataset["test_image_names"]))
+def select_members(val_scores, y_val, names):
+    """
+    Greedy ensemble selection on the validation scores. Prints the accuracy for
+    every ensemble size and returns the member weights of the smallest ensemble
+    reaching FLAGS.target_acc.
+    """
+    members, history = greedy_selection(val_scores, y_val, max_members=FLAGS.max_members or None)
+    print (selection_report(names, members, history))
+
+    members = smallest_ensemble(members, history, FLAGS.target_acc or None)
+    weights = member_weights(members, len(names))
+    print ("Selected %d of %d snapshots in %d steps, validation accuracy %f"
+           % (np.count_nonzero(weights), len(names), len(members), accuracy(weighted_scores(val_scores, weights), y_val)))
+
+    if FLAGS.fit_weights:
+        # Only the selected snapshots take part, so the ensemble does not grow. The lowest
+        # log loss does not always mean the best accuracy, so the fit has to earn its place
+        selected = weights > 0
+        fitted = weights.copy()
+        fitted[selected] = fit_weights(val_scores[selected], y_val, weights[selected])
+        fitted_acc = accuracy(weighted_scores(val_scores, fitted), y_val)
+        print ("Fitted weights, validation accuracy %f" % fitted_acc)
+        if fitted_acc >= accuracy(weighted_scores(val_scores, weights), y_val):
+            weights = fitted
+        else:
+            print ("Keeping the greedy weights")
+
+    for name, w in zip(names, weights):
+        if w > 0:
+            print ("  %.3f %s" % (w, name))
+    return weights
+
+
+def snapshot_checkpoints(folders):
+    """
+    The latest checkpoint of every folder that has one, as (folder, checkpoint) pairs
+    """
+    checkpoints = []
+    for folder in sorted(folders):
+        ckpt = tf.train.get_checkpoint_state(folder)
+        if ckpt is None:
+            logging.info("No checkpoint in %s, skipping it" % folder)
+            continue
+        checkpoints.append((folder, ckpt.model_checkpoint_path))
+    if not checkpoints:
+        raise ValueError("No checkpoints found in %s" % FLAGS.train_dir)
+    logging.info("%d snapshots: %s" % (len(checkpoints), ", ".join(folder for folder, _ in checkpoints)))
+    return checkpoints
+
+
+_model = []
+
+def get_model():
+    # Only build the graph once some snapshot actually has to be run
+    if not _model:
+        print ("Creating '" + FLAGS.classifier + "'")
+        classifier = get_classifier(FLAGS.classifier, FLAGS)
+
+        print ("Creating Model")
+        _model.append(Model(classifier, FLAGS))
+    return _model[0]
+
+
+def ensemble_scores(checkpoints, weights, X):
+    """
+    Weighted average scores of the snapshots on X, from one graph holding all of them
+    """
+    print ("Creating '" + FLAGS.classifier + "' Ensemble of %d snapshots" % len(checkpoints))
+    classifiers = [get_classifier(FLAGS.classifier, FLAGS) for _ in checkpoints]
+    model = EnsembleModel(classifiers, FLAGS)
+
+    with tf.Session() as sess:
+        model.restore(sess, [checkpoint for _, checkpoint in checkpoints], weights / np.sum(weights))
+
+        print ("Generating Ensemble Scores")
+        return model.crop_scores(sess, X, tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
 
-    scores = {}
-    for img, img_name in tqdm(test_data):
-        file_name = img_name.split("/")[-1]
-        img = np.expand_dims(img, axis=0)
-        score = model.crop_classify(sess, img, raw_score = True)
-        scores[file_name] = score
 
-    print ("Generated {}/{} Scores".format(len(scores), len(test_data)))
-    return scores
+def snapshot_scores(cache, checkpoints, split, X, names):
+    """
+    (num_snapshots, len(names), n_classes) scores of every snapshot on X. Cached
+    scores are reused; only the images a snapshot has not scored yet are run.
+    """
+    split = split_name(split + ("-debug" if FLAGS.debug else ""), FLAGS.tta_threshold, FLAGS.tta_gate, FLAGS.augment)
+    workers = FLAGS.score_workers or multiprocessing.cpu_count()
+    computed = parallel_scores(cache, checkpoints, split, X, names, workers) if workers > 1 else {}
+
+    all_scores = []
+    for folder, checkpoint in checkpoints:
+        def compute(indices):
+            if checkpoint in computed:
+                assert(len(computed[checkpoint]) == len(indices))
+                return computed[checkpoint]
+
+            model = get_model()
+            with tf.Session() as sess:
+                print ("model dir: ", folder)
+                initialize_model(sess, model, folder)
+
+                print ("Generating %s Scores for %d images" % (split, len(indices)))
+                return model.crop_scores(sess, X[indices], tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+
+        all_scores.append(cache.get_or_compute(checkpoint, split, names, compute))
+
+    print ("Have {} scores for {} snapshots".format(split, len(all_scores)))
+    return np.stack(all_scores)
+
+
+def parallel_scores(cache, checkpoints, split, X, names, workers):
+    """
+    Scores the images the cache is missing for every snapshot with a pool of worker
+    processes. X is shared through a temporary .npy file, and every worker writes its
+    rows into a memory-mapped output array per snapshot. When there are fewer
+    snapshots than workers, the images of a snapshot are split into shards.
+
+    :return: {checkpoint: scores of its missing images}, in the order get_or_compute asks for them
+    """
+    names = list(names)
+    todo = [(folder, checkpoint, cache.missing(checkpoint, split, names)) for folder, checkpoint in checkpoints]
+    todo = [(folder, checkpoint, missing) for folder, checkpoint, missing in todo if missing]
+    if not todo:
+        return {}
+
+    tmp = os.path.join(cache.cache_dir, "tmp-%d-" % os.getpid())
+    X_file = tmp + "X.npy"
+    out_files = {}
+    try:
+        np.save(X_file, X)
+        shards_per_snapshot = int(math.ceil(workers / float(len(todo))))
+        tasks = []
+        for i, (folder, checkpoint, missing) in enumerate(todo):
+            out_files[checkpoint] = tmp + "scores%d.npy" % i
+            out = np.lib.format.open_memmap(out_files[checkpoint], mode='w+', dtype=np.float32, shape=(len(missing), FLAGS.n_classes))
+            del out
+            for shard in np.array_split(np.arange(len(missing)), min(shards_per_snapshot, len(missing))):
+                tasks.append((os.path.abspath(folder), X_file, out_files[checkpoint], [missing[j] for j in shard], int(shard[0])))
+
+        # Spawned, not forked: the workers must not inherit this process' TensorFlow state
+        workers = min(workers, len(tasks))
+        threads = FLAGS.score_threads or max(1, multiprocessing.cpu_count() // workers)
+        print ("Generating %s Scores for %d snapshots in %d processes (%d threads each)" % (split, len(todo), workers, threads))
+        pool = multiprocessing.get_context("spawn").Pool(workers, init_score_worker, (dict(FLAGS.__flags), threads))
+        try:
+            for done, (folder, num_images) in enumerate(pool.imap_unordered(score_shard, tasks)):
+                print ("%s: %d images scored (%d/%d shards)" % (folder, num_images, done + 1, len(tasks)))
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+        return {checkpoint: np.load(out_file) for checkpoint, out_file in out_files.items()}
+    finally:
+        for filename in [X_file] + list(out_files.values()):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+_worker = {}
+
+def init_score_worker(flag_values, threads):
+    """ Pool initializer: the parent's flags, and the TensorFlow thread limits of this process """
+    FLAGS.classifier   # parse the command line now, so it can't overwrite the values below later
+    for name, value in flag_values.items():
+        setattr(FLAGS, name, value)
+    _worker['config'] = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+
+
+def score_shard(task):
+    """ Pool worker: scores images of X_file with the snapshot in folder into rows start... of out_file """
+    folder, X_file, out_file, indices, start = task
+    X = np.load(X_file, mmap_mode='r')
+    model = get_model()
+    with tf.Session(config=_worker['config']) as sess:
+        initialize_model(sess, model, folder)
+        scores = model.crop_scores(sess, X[indices], tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+
+    out = np.load(out_file, mmap_mode='r+')
+    out[start:start + len(indices)] = scores
+    out.flush()
+    return folder, len(indices)
 
 
 def main(_):
@@ -170,7 +411,7 @@ def main(_):
     # ======== Answer with an Ensemble ========
     if FLAGS.method == "hard":
         majority_vote()
-    elif FLAGS.method == "soft":
+    elif FLAGS.method in ("soft", "greedy"):
         average_prob()
     else:
         raise Exception("InvalidMethodError")
@@ -0,0 +1,138 @@
+"""
+Ensemble selection from cached validation scores (see score_cache.py).
+
+All functions take the softmax scores of M candidate models on the same N
+validation images as an (M, N, n_classes) array and the N labels, and only
+use numpy, so trying out ensembles costs no inference at all.
+
+    - greedy_selection: forward selection with replacement (Caruana et al.,
+      "Ensemble Selection from Libraries of Models"). Every step adds the
+      member that most improves the accuracy of the averaged scores; a model
+      picked k times gets weight k.
+    - fit_weights: per-member weights of the averaged scores that minimize
+      the validation log loss, by exponentiated gradient descent.
+
+hard_vote is the majority vote counterpart for integer predictions.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+
+def accuracy(scores, y):
+    return np.mean(np.argmax(scores, axis=-1) == y, axis=-1)
+
+
+def log_loss(scores, y, eps=1e-12):
+    # scores (..., N, n_classes) -> mean negative log probability of the labels
+    correct = np.take_along_axis(scores, y.reshape((1,) * (scores.ndim - 2) + (-1, 1)), axis=-1)[..., 0]
+    return -np.mean(np.log(correct + eps), axis=-1)
+
+
+def greedy_selection(scores, y, max_members=None, with_replacement=True):
+    """
+    Forward selection of ensemble members.
+
+    :return: members, history. members[i] is the model added at step i (a model
+             can appear several times), history[i] the validation accuracy of
+             the average of members[:i+1].
+    """
+    M = scores.shape[0]
+    max_members = max_members or (2 * M if with_replacement else M)
+    y = np.asarray(y)
+
+    total = np.zeros(scores.shape[1:], dtype=np.float64)
+    available = np.ones(M, dtype=bool)
+    members, history = [], []
+    for step in range(max_members):
+        if not available.any():
+            break
+        candidates = (total + scores) / (step + 1)   # (M, N, n_classes): the ensemble with each model added
+        acc = accuracy(candidates, y)
+        loss = log_loss(candidates, y)
+        acc[~available] = -1
+
+        # Best accuracy, ties broken by log loss
+        best = np.lexsort((loss, -acc))[0]
+        members.append(int(best))
+        history.append(float(acc[best]))
+        total += scores[best]
+        if not with_replacement:
+            available[best] = False
+    return members, history
+
+
+def member_weights(members, num_models):
+    """ Weights (summing to 1) of a greedy selection """
+    counts = np.bincount(members, minlength=num_models).astype(np.float64)
+    return counts / counts.sum()
+
+
+def smallest_ensemble(members, history, target=None):
+    """
+    Shortest prefix of a greedy selection that reaches target accuracy (or the
+    best accuracy when target is None or never reached).
+
+    :return: members of that prefix
+    """
+    history = np.asarray(history)
+    if target is not None and np.any(history >= target):
+        size = int(np.argmax(history >= target)) + 1
+    else:
+        size = int(np.argmax(history)) + 1
+    return members[:size]
+
+
+def fit_weights(scores, y, weights=None, iters=200, lr=1.0):
+    """
+    Weights w (w >= 0, sum(w) = 1) that minimize the log loss of
+    sum_m w[m] * scores[m] on the validation set, starting from weights
+    (default: uniform). Only the probabilities of the true labels matter,
+    so every iteration is an (M, N) computation.
+    """
+    M = scores.shape[0]
+    y = np.asarray(y)
+    correct = np.take_along_axis(scores, y.reshape(1, -1, 1), axis=2)[:, :, 0].astype(np.float64)   # (M, N)
+    w = np.full(M, 1.0 / M) if weights is None else np.asarray(weights, dtype=np.float64)
+    for _ in range(iters):
+        p = np.maximum(w.dot(correct), 1e-12)
+        grad = -np.mean(correct / p, axis=1)
+        w = w * np.exp(-lr * grad)
+        w /= w.sum()
+    return w
+
+
+def weighted_scores(scores, weights):
+    return np.tensordot(weights, scores, axes=1)
+
+
+def selection_report(names, members, history):
+    """ Validation accuracy against ensemble size, one line per greedy step """
+    lines = ["%8s %8s %8s  %s" % ("step", "models", "val acc", "added")]
+    for i, (member, acc) in enumerate(zip(members, history)):
+        lines.append("%8d %8d %8.4f  %s" % (i + 1, len(set(members[:i + 1])), acc, names[member]))
+    return "\n".join(lines)
+
+
+def hard_vote(labels, num_classes):
+    """
+    Majority vote of integer predictions.
+
+    :param labels: (M, N) class of image n according to model m, or -1 where
+                   model m has no answer for image n. Rows are in priority order:
+                   a tie between classes goes to the one voted for by the first
+                   model that voted for any of them.
+    :return: (N,) winning class of every image (-1 for images without votes)
+    """
+    labels = np.asarray(labels)
+    M, N = labels.shape
+    voted = labels >= 0
+    image = np.broadcast_to(np.arange(N), labels.shape)
+    counts = np.bincount((image * num_classes + labels)[voted], minlength=N * num_classes).reshape(N, num_classes)
+
+    best = counts.max(axis=1)
+    in_tie = voted & (counts[image, np.where(voted, labels, 0)] == best)
+    first = np.argmax(in_tie, axis=0)
+    winners = labels[first, np.arange(N)]
+    winners[best == 0] = -1
+    return winners
@@ -4,6 +4,7 @@ import json
 import sys
 import random
 import re
+import time
 from os.path import join as pjoin
 
 from tqdm import tqdm
@@ -36,33 +37,34 @@ tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (
 tf.app.flags.DEFINE_bool("debug", False, "Run on a small set of data for debugging.")
 tf.app.flags.DEFINE_bool("augment", True, "Whether or not to expand dataset using data augmentation")
 tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding JPEGs when there is no packed dataset (0: one per core).")
+tf.app.flags.DEFINE_float("tta_threshold", 0.0, "Adaptive test-time augmentation: score all 10 crops only for images whose center crop confidence is below this (0: always all 10).")
+tf.app.flags.DEFINE_string("tta_gate", "max_prob", "Confidence used by --tta_threshold: max_prob (highest probability) or margin (highest minus second highest).")
+tf.app.flags.DEFINE_string("tta_sweep", "", "Comma separated tta_threshold values to compare on the validation set, e.g. 0.5,0.8,0.9,0.95,0.99")
+tf.app.flags.DEFINE_bool("lazy_normalize", False, "Keep images as uint8 and subtract the mean image per batch (4x less memory).")
+tf.app.flags.DEFINE_bool("per_channel_norm", False, "Without a normalization.npz in train_dir: recompute the per-channel mean and std instead of the mean image.")
 
 FLAGS = tf.app.flags.FLAGS
 
-def generate_answers(sess, model, dataset):
+def tta_sweep(sess, model, dataset, thresholds):
     """
-    Loop over the dev or test dataset and generate answer.
-
-    You must implement this function in order to submit to Leaderboard.
-
-    :param sess: active TF session
-    :param model: a built QASystem model
-    :return:
+    Accuracy and throughput on the validation set for every adaptive TTA threshold
+    (0 is the full 10 crops for every image).
     """
-
-    test_data = list(zip(dataset["X_test"], dataset["test_image_names"]))
-    label_to_wnid = dataset["label_to_wnid"]
-
-    batches, num_batches = get_batches(test_data, FLAGS.batch_size)
-
-    answers = []
-    for img, img_name in tqdm(test_data):
-        img = np.expand_dims(img, axis=0)
-        pred = model.crop_classify(sess, img)
-        answers.append((img_name, label_to_wnid[pred]))
-
-    print ("Generated {}/{} Answers".format(len(answers), len(test_data)))
-    return process_answers(answers)
+    X_val, y_val = dataset["X_val"], dataset["y_val"]
+    print("Adaptive TTA sweep on %d validation images (gate: %s)" % (len(y_val), FLAGS.tta_gate))
+    print("%10s %8s %8s %10s %10s %12s" % ("threshold", "top-1", "top-5", "10-crop", "crops/img", "images/sec"))
+    for threshold in [0.0] + thresholds:
+        start = time.time()
+        results = model.evaluate_model(sess, X_val, y_val, tta_threshold=threshold, tta_gate=FLAGS.tta_gate)
+        elapsed = time.time() - start
+        expanded = model.tta_stats['expanded'] / float(model.tta_stats['images'])
+        if not FLAGS.augment:
+            crops = 1
+        else:
+            crops = 10 if threshold == 0 else 1 + 9 * expanded
+        print("%10g %8.4f %8.4f %9.1f%% %10.2f %12.0f"
+              % (threshold, results['top1'], results['top5'], 100 * expanded, crops, len(y_val) / elapsed))
 
 
 def main(_):
@@ -76,43 +78,57 @@ def main(_):
     with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
         json.dump(FLAGS.__flags, fout)
 
+    # ========= Model-specific =========
+    print ("Creating '" + FLAGS.classifier + "'")
+    classifier = get_classifier(FLAGS.classifier, FLAGS)
+    if FLAGS.train_dir == "":
+        FLAGS.train_dir = pjoin("train", classifier.name())
+
     # ========= Load Dataset =========
+    # Score with the statistics the model was trained with (e.g. --per_channel_norm)
+    normalization = load_normalization(FLAGS.train_dir)
+    if normalization is None:
+        logging.warning("No normalization.npz in %s, recomputing the statistics from the training set" % FLAGS.train_dir)
+        normalization = load_train_stats(FLAGS.data_dir, FLAGS.num_workers).normalization(FLAGS.per_channel_norm)
+
     print ("Loading Tiny-Imagenet Dataset")
-    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = True, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug)   # Get the validation set
+    dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = True, val_only = True, dtype=np.uint8 if FLAGS.lazy_normalize else np.float32, subtract_mean=True, debug=FLAGS.debug, num_workers=FLAGS.num_workers, normalization=normalization)   # Get the validation set
 
     #Store img sizes
-    FLAGS.img_C = dataset["X_train"].shape[3]
+    FLAGS.img_C = dataset["X_val"].shape[3]
     if FLAGS.augment:
         jitter = 8
-        FLAGS.img_H = dataset["X_train"].shape[1] - jitter
-        FLAGS.img_W = dataset["X_train"].shape[2] - jitter
+        FLAGS.img_H = dataset["X_val"].shape[1] - jitter
+        FLAGS.img_W = dataset["X_val"].shape[2] - jitter
     else: 
-        FLAGS.img_H = dataset["X_train"].shape[1]
-        FLAGS.img_W = dataset["X_train"].shape[2]
+        FLAGS.img_H = dataset["X_val"].shape[1]
+        FLAGS.img_W = dataset["X_val"].shape[2]
     print ("Imgs are (" + str(FLAGS.img_H) + ", " + str(FLAGS.img_W) + ", " + str(FLAGS.img_C) + ")")
 
-    # ========= Model-specific =========
-    print ("Creating '" + FLAGS.classifier + "'")
-    classifier = get_classifier(FLAGS.classifier, FLAGS)
-
     print ("Creating Model")
-    model = Model(classifier, FLAGS)
+    model = Model(classifier, FLAGS, normalization=dataset.get("normalization") if FLAGS.lazy_normalize else None)
 
     with tf.Session() as sess:
-        if FLAGS.train_dir == "":
-            FLAGS.train_dir = pjoin("train", classifier.name())
         print ("train_dir: ", FLAGS.train_dir)
         initialize_model(sess, model, FLAGS.train_dir)
 
-        val_data = list(zip(dataset["X_val"], dataset["y_val"]))
-        eval_size = len(val_data)
-
-        top1acc = model.evaluate_model(sess, val_data, eval_size, top5 = False)
-        print("Top-1 Validation Accuracy: %f \ton %d examples" % (top1acc, eval_size))
-
-        top5acc = model.evaluate_model(sess, val_data, eval_size, top5 = True)
-        print("Top-5 Validation Accuracy: %f \ton %d examples" % (top5acc, eval_size))
-
+        eval_size = len(dataset["y_val"])
+        results = model.evaluate_model(sess, dataset["X_val"], dataset["y_val"], tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+        print("Top-1 Validation Accuracy: %f \ton %d examples" % (results['top1'], eval_size))
+        print("Top-5 Validation Accuracy: %f \ton %d examples" % (results['top5'], eval_size))
+
+        # Per class top-1 accuracy, worst classes first
+        per_class = results['per_class']
+        order = [c for c in np.argsort(per_class) if not np.isnan(per_class[c])]
+        print("Worst classes:")
+        for c in order[:10]:
+            print("  %-6.3f %s" % (per_class[c], ", ".join(dataset["class_names"][c])))
+        print("Best classes:")
+        for c in order[-10:][::-1]:
+            print("  %-6.3f %s" % (per_class[c], ", ".join(dataset["class_names"][c])))
+
+        if FLAGS.tta_sweep:
+            tta_sweep(sess, model, dataset, [float(t) for t in FLAGS.tta_sweep.split(",")])
 
 
 if __name__ == "__main__":
@@ -13,3 +13,5 @@ pip install -r $CODE_DIR/requirements.txt
 
 python $CODE_DIR/preprocessing/get_dataset.py
 
+
+python $CODE_DIR/preprocessing/pack_dataset.py
@@ -0,0 +1,104 @@
+"""
+Load generator for serve.py.
+
+Sends prediction requests from several concurrent clients and reports the
+throughput and the client side latency percentiles, followed by the server's
+own /metrics. Requests carry either real images (--image_dir, sent as encoded
+files) or random 64x64 images (sent as one .npy array per request).
+
+    python loadgen.py --url=http://127.0.0.1:8000 --concurrency=16 --requests=2000
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import glob
+import io
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from six.moves.urllib.request import Request, urlopen
+
+
+def make_payloads(image_dir, batch, count=64):
+    """ count request bodies with batch images each, as (body, content type) """
+    if image_dir:
+        files = sorted(glob.glob(os.path.join(image_dir, '*')))
+        assert files, "no files in %s" % image_dir
+        encoded = []
+        for filename in files[:count * batch]:
+            with open(filename, 'rb') as f:
+                encoded.append(base64.b64encode(f.read()).decode('ascii'))
+        payloads = []
+        for i in range(count):
+            images = [encoded[(i * batch + j) % len(encoded)] for j in range(batch)]
+            payloads.append((json.dumps({'images': images}).encode('utf-8'), 'application/json'))
+        return payloads
+
+    payloads = []
+    for _ in range(count):
+        f = io.BytesIO()
+        np.save(f, np.random.randint(0, 256, size=(batch, 64, 64, 3), dtype=np.uint8))
+        payloads.append((f.getvalue(), 'application/x-npy'))
+    return payloads
+
+
+def run(url, payloads, concurrency, num_requests, top_k):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            body, content_type = payloads[i % len(payloads)]
+            request = Request(url + '/predict?top_k=%d' % top_k, data=body, headers={'Content-Type': content_type})
+            start = time.time()
+            try:
+                urlopen(request).read()
+                with lock:
+                    latencies.append(time.time() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, np.array(latencies), errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark a running serve.py")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="Server address")
+    parser.add_argument('--concurrency', type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument('--requests', type=int, default=1000, help="Total number of requests")
+    parser.add_argument('--batch', type=int, default=1, help="Images per request")
+    parser.add_argument('--top_k', type=int, default=5, help="Classes returned per image")
+    parser.add_argument('--image_dir', default=None, help="Send these image files instead of random images")
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.image_dir, args.batch)
+    elapsed, latencies, errors = run(args.url.rstrip('/'), payloads, args.concurrency, args.requests, args.top_k)
+
+    print("%d requests (%d images) in %.2fs from %d clients: %.1f requests/sec, %.1f images/sec, %d errors"
+          % (len(latencies), len(latencies) * args.batch, elapsed, args.concurrency,
+             len(latencies) / elapsed, len(latencies) * args.batch / elapsed, len(errors)))
+    if errors:
+        print("First error: %s" % errors[0])
+    if len(latencies):
+        p50, p90, p99 = 1000 * np.percentile(latencies, [50, 90, 99])
+        print("Client latency: mean %.1f ms, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms"
+              % (1000 * latencies.mean(), p50, p90, p99, 1000 * latencies.max()))
+
+    print("Server metrics:")
+    print(json.dumps(json.loads(urlopen(args.url.rstrip('/') + '/metrics').read().decode('utf-8')), indent=1))
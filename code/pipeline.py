@@ -0,0 +1,163 @@
+"""
+Background input pipeline for training.
+
+BatchPrefetcher runs a batch preparation function (gather, normalize, augment)
+on worker threads and hands finished batches to the training loop through a
+bounded queue, so the next batches are being prepared while session.run is
+busy with the current one. The numpy work in the preparation function
+releases the GIL for most of its time, so threads overlap well with both
+TensorFlow and each other.
+
+It also times the consumer: how long the training loop sat waiting for a
+batch (input-bound) versus how long it spent between batches, i.e. in the
+training step itself (compute-bound).
+"""
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+import six
+from six.moves import queue
+
+
+class _WorkerError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+_DONE = object()
+
+
+class BatchPrefetcher(object):
+    """
+    Iterates over prepare(item) for every item, computed ahead of time by
+    num_workers threads and buffered in a queue of at most depth batches.
+    With several workers, batches are returned in the order they finish.
+    num_workers=0 prepares every batch inline when it is requested, which
+    keeps the timing but overlaps nothing.
+
+    Usage:
+        with BatchPrefetcher(batches, prepare, num_workers=2) as prefetcher:
+            for X_batch, y_batch in prefetcher:
+                ...
+            print(prefetcher.stats())
+    """
+
+    def __init__(self, items, prepare, num_workers=2, depth=4):
+        self.prepare = prepare
+        self.num_workers = num_workers
+        self.wait_time = 0.0
+        self.step_time = 0.0
+        self.num_batches = 0
+        self._items = iter(items)
+        self._last = None
+        self._done = False
+        self._stop = threading.Event()
+        self._threads = []
+
+        if num_workers > 0:
+            self._lock = threading.Lock()
+            self._queue = queue.Queue(maxsize=max(1, depth))
+            self._running = num_workers
+            for _ in range(num_workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_item(self):
+        with self._lock:
+            return next(self._items)
+
+    def _put(self, value):
+        # Keep checking for close() so a worker never blocks forever on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _work(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    item = self._next_item()
+                except StopIteration:
+                    break
+                self._put(self.prepare(item))
+        except Exception:
+            self._put(_WorkerError(sys.exc_info()))
+        finally:
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            if last:
+                self._put(_DONE)
+
+    def _get(self):
+        if self._done:
+            raise StopIteration
+        if self.num_workers == 0:
+            return self.prepare(next(self._items))
+        value = self._queue.get()
+        if value is _DONE:
+            self._done = True
+            raise StopIteration
+        if isinstance(value, _WorkerError):
+            self.close()
+            six.reraise(*value.exc_info)
+        return value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        if self._last is not None:
+            self.step_time += start - self._last
+        try:
+            batch = self._get()
+        except StopIteration:
+            self._last = None
+            raise
+        self._last = time.time()
+        self.wait_time += self._last - start
+        self.num_batches += 1
+        return batch
+
+    next = __next__   # Python 2
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        """
+        Time the consumer spent waiting for batches and time spent in between
+        (the training step). input_bound is the waiting fraction: near 0 the
+        GPU is the bottleneck, near 1 the input pipeline is.
+        """
+        total = self.wait_time + self.step_time
+        return {
+            'batches': self.num_batches,
+            'wait_time': self.wait_time,
+            'step_time': self.step_time,
+            'input_bound': self.wait_time / total if total > 0 else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ("Input pipeline: %.1fs waiting for batches, %.1fs in training steps over %d batches (%.0f%% input-bound, %s)"
+                % (stats['wait_time'], stats['step_time'], stats['batches'], 100 * stats['input_bound'],
+                   "input-bound" if stats['input_bound'] > 0.1 else "compute-bound"))
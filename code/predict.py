@@ -0,0 +1,170 @@
+"""
+Label an arbitrary number of images with a trained model.
+
+Unlike answer.py, nothing is loaded up front: the files are decoded by a pool
+of worker processes a chunk at a time (at most --prefetch_chunks chunks ahead
+of the model), resized to 64x64 when needed, scored, and written to the output
+file as "file_name wnid" lines, the competition answer format, in input order.
+Memory stays bounded by the chunk size however many images there are.
+
+Inputs (--inputs, comma separated) can be directories, glob patterns or text
+files listing one image path per line:
+
+    python predict.py --classifier=DemoClassifier --inputs="dump/*.jpg" --output=labels.txt
+"""
+from __future__ import print_function
+
+import glob
+import io
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from os.path import join as pjoin
+
+import numpy as np
+import tensorflow as tf
+
+from ti_model import Model
+from ti_classifiers import get_classifier
+from utils import initialize_model
+from data_utils import decode_image, load_normalization, load_train_stats, load_wnids
+
+logging.basicConfig(level=logging.INFO)
+
+# Hyperparams
+tf.app.flags.DEFINE_float("learning_rate", 0.0005, "Learning rate.")
+tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
+tf.app.flags.DEFINE_integer("batch_size", 256, "Batch size to use during training.")
+tf.app.flags.DEFINE_string("optimizer", "adam", "The name of the classifier to use. For easily switching between classifiers.")
+tf.app.flags.DEFINE_float("weight_decay", 0.0001, "Weight decay coefficient, some models may not use this")
+
+# Convenience
+tf.app.flags.DEFINE_string("classifier", "DemoClassifier", "The name of the classifier to use. For easily switching between classifiers.")
+tf.app.flags.DEFINE_string("data_dir", "data/tiny-imagenet-200", "tiny-imagenet directory, zip or packed cache, for the class list (default ./data/tiny-imagenet-200)")
+tf.app.flags.DEFINE_string("train_dir", "", "Training directory to load the model parameters from (default: ./train/classifier).")
+tf.app.flags.DEFINE_bool("augment", True, "Whether or not the model was trained with data augmentation (10-crop scoring)")
+tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
+tf.app.flags.DEFINE_float("tta_threshold", 0.0, "Adaptive test-time augmentation: score all 10 crops only for images whose center crop confidence is below this (0: always all 10).")
+tf.app.flags.DEFINE_string("tta_gate", "max_prob", "Confidence used by --tta_threshold: max_prob (highest probability) or margin (highest minus second highest).")
+
+# Prediction
+tf.app.flags.DEFINE_string("inputs", "", "Comma separated directories, glob patterns or text files with one image path per line.")
+tf.app.flags.DEFINE_string("output", "", "Answer file to write (default: {train_dir}/predictions.txt).")
+tf.app.flags.DEFINE_integer("chunk_size", 1024, "Images decoded and scored together.")
+tf.app.flags.DEFINE_integer("prefetch_chunks", 2, "Max number of chunks being decoded ahead of the model.")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding images, and the training images when there is neither a normalization.npz nor a packed dataset (0: one per core).")
+
+FLAGS = tf.app.flags.FLAGS
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.bmp', '.gif')
+
+
+def iter_image_files(inputs):
+    """ Image paths named by inputs (directories, globs or list files), lazily """
+    for item in inputs:
+        if os.path.isdir(item):
+            names = sorted(entry.name for entry in os.scandir(item) if entry.is_file())
+            for name in names:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(item, name)
+        elif os.path.isfile(item) and item.lower().endswith('.txt'):
+            with io.open(item, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        yield line.strip()
+        else:
+            for path in sorted(glob.iglob(item)):
+                yield path
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_files(img_files):
+    """ (images, ok): decoded 64x64 uint8 images, and which files could be read """
+    X = np.zeros((len(img_files), 64, 64, 3), dtype=np.uint8)
+    ok = np.zeros(len(img_files), dtype=bool)
+    for i, img_file in enumerate(img_files):
+        try:
+            with open(img_file, 'rb') as f:
+                X[i] = decode_image(f.read())
+            ok[i] = True
+        except Exception as e:
+            logging.warning("Skipping %s: %s" % (img_file, e))
+    return X, ok
+
+
+def iter_decoded(chunks, pool, prefetch):
+    """ (img_files, images, ok) per chunk, decoded by pool with at most prefetch chunks in flight """
+    pending = deque()
+    for chunk in chunks:
+        pending.append((chunk, pool.apply_async(decode_files, (chunk,))))
+        if len(pending) > prefetch:
+            img_files, result = pending.popleft()
+            yield (img_files,) + result.get()
+    while pending:
+        img_files, result = pending.popleft()
+        yield (img_files,) + result.get()
+
+
+def main(_):
+    assert FLAGS.inputs, "--inputs is required"
+    if FLAGS.train_dir == "":
+        FLAGS.train_dir = pjoin("train", FLAGS.classifier)
+    output = FLAGS.output or pjoin(FLAGS.train_dir, "predictions.txt")
+
+    wnids, _ = load_wnids(FLAGS.data_dir)
+    normalization = load_normalization(FLAGS.train_dir)
+    if normalization is None:
+        logging.warning("No normalization.npz in %s, recomputing the statistics from the training set" % FLAGS.train_dir)
+        normalization = load_train_stats(FLAGS.data_dir, FLAGS.num_workers).normalization()
+
+    #Store img sizes
+    jitter = 8 if FLAGS.augment else 0
+    FLAGS.img_H = 64 - jitter
+    FLAGS.img_W = 64 - jitter
+    FLAGS.img_C = 3
+
+    print ("Creating '" + FLAGS.classifier + "'")
+    classifier = get_classifier(FLAGS.classifier, FLAGS)
+
+    print ("Creating Model")
+    model = Model(classifier, FLAGS, normalization=normalization)
+
+    num_workers = FLAGS.num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        with tf.Session() as sess, io.open(output, 'w') as f:
+            print ("train_dir: ", FLAGS.train_dir)
+            initialize_model(sess, model, FLAGS.train_dir)
+
+            print ("Writing predictions to " + output)
+            start = time.time()
+            num_images, num_skipped = 0, 0
+            chunks = iter_chunks(iter_image_files(FLAGS.inputs.split(",")), FLAGS.chunk_size)
+            for img_files, X, ok in iter_decoded(chunks, pool, FLAGS.prefetch_chunks):
+                if ok.any():
+                    scores = model.crop_scores(sess, X[ok], tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+                    for img_file, pred in zip(np.array(img_files)[ok], np.argmax(scores, axis=1)):
+                        print(os.path.basename(img_file) + " " + wnids[pred], file=f)
+                    f.flush()
+                num_images += int(ok.sum())
+                num_skipped += int((~ok).sum())
+                logging.info("%d images labeled (%.1f images/sec), %d skipped"
+                             % (num_images, num_images / (time.time() - start), num_skipped))
+    finally:
+        pool.terminate()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -1,9 +1,27 @@
+import os
+import sys
 import zipfile
 import shutil
+import argparse
 from maybe_download import *
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_utils import pack_tiny_imagenet
+from shards import write_tiny_imagenet_shards
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download tiny-imagenet and prepare it in ./data")
+    parser.add_argument("--no_extract", action="store_true",
+                        help="Build the packed dataset straight from the zip instead of extracting ~120k loose files")
+    parser.add_argument("--shards", action="store_true", help="With --no_extract, also write the sharded training set")
+    parser.add_argument("--num_workers", type=int, default=0, help="Decoding processes (default: one per core)")
+    parser.add_argument("--mirror", action="append", default=[],
+                        help="Local directory, file:// URL or URL holding a copy of the zip, tried before the original (repeatable)")
+    parser.add_argument("--sha256", default=None, help="Expected SHA-256 of the zip")
+    parser.add_argument("--num_connections", type=int, default=4, help="Parallel range requests for the download")
+    args = parser.parse_args()
+
     tinyimagenet_base_url = "http://cs231n.stanford.edu/"
     tinyimagenet_filename = "tiny-imagenet-200.zip"
     unzipped_filename = "tiny-imagenet-200"
@@ -18,7 +36,17 @@ if __name__ == '__main__':
     if not os.path.exists(data_prefix):
         os.makedirs(data_prefix)
     
-    glove_zip = maybe_download(tinyimagenet_base_url, tinyimagenet_filename, prefix, None)
+    glove_zip = maybe_download(tinyimagenet_base_url, tinyimagenet_filename, prefix, None,
+                               sha256=args.sha256, mirrors=args.mirror, num_connections=args.num_connections)
+
+    if args.no_extract:
+        zip_path = os.path.join(prefix, tinyimagenet_filename)
+        data_dir = os.path.join(data_prefix, unzipped_filename)
+        print("Packing datasets from {} into {}".format(zip_path, data_dir))
+        pack_tiny_imagenet(zip_path, os.path.join(data_dir, "packed"), args.num_workers)
+        if args.shards:
+            write_tiny_imagenet_shards(zip_path, os.path.join(data_dir, "shards"), num_workers=args.num_workers)
+        sys.exit(0)
 
     print("Extracting")
     glove_zip_ref = zipfile.ZipFile(os.path.join(prefix, tinyimagenet_filename), 'r')
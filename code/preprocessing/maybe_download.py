@@ -1,54 +1,212 @@
 import linecache
 import os
 import sys
+import json
+import shutil
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
 import random
 
 from collections import Counter
-from six.moves.urllib.request import urlretrieve
+from six.moves.urllib.request import urlopen, Request, url2pathname
+from six.moves.urllib.parse import urlparse
 
 random.seed(42)
 
 tinyimagenet_base_url = "http://cs231n.stanford.edu/tiny-imagenet-200.zip"
 
-def reporthook(t):
-  """https://github.com/tqdm/tqdm"""
-  last_b = [0]
+def maybe_download(url, filename, prefix, num_bytes=None, sha256=None, mirrors=None, num_connections=1):
+    """Takes an URL, a filename, and the expected bytes, download
+    the contents and returns the filename
+    num_bytes=None disables the file size check.
+    sha256: expected hex digest of the file, None disables the checksum.
+    mirrors: local directories, file:// URLs or other base URLs that are tried
+        before url, so CI and air-gapped hosts can seed from a cache.
+    num_connections: number of parallel HTTP range requests.
+
+    Downloads go to <filename>.part and are only renamed once complete and
+    verified, so an interrupted download is resumed (with range requests when
+    the server supports them) instead of being mistaken for the whole file."""
+    local_filename = os.path.join(prefix, filename)
+    if os.path.exists(local_filename):
+        try:
+            verify_file(local_filename, num_bytes, sha256)
+            print("File {} successfully loaded".format(filename))
+            return local_filename
+        except ValueError as e:
+            print("{}, downloading it again".format(e))
+            os.remove(local_filename)
+
+    errors = []
+    for base in list(mirrors or []) + [url]:
+        try:
+            print("Downloading file {}...".format(_join_url(base, filename)))
+            _fetch(base, filename, local_filename + ".part", num_connections)
+            verify_file(local_filename + ".part", num_bytes, sha256)
+        except ValueError as e:
+            # A complete file with the wrong contents can not be resumed
+            print("Could not get {} from {}: {}".format(filename, base, e))
+            errors.append(e)
+            if os.path.exists(local_filename + ".part"):
+                os.remove(local_filename + ".part")
+            continue
+        except (IOError, OSError) as e:
+            print("Could not get {} from {}: {}".format(filename, base, e))
+            errors.append(e)
+            continue
+        os.rename(local_filename + ".part", local_filename)
+        print("File {} successfully loaded".format(filename))
+        return local_filename
+
+    print("An error occurred when downloading the file! Please get the dataset using a browser.")
+    raise errors[-1]
+
+
+def verify_file(local_filename, num_bytes=None, sha256=None):
+    """Raises ValueError if the file does not have the expected size or SHA-256 digest."""
+    file_stats = os.stat(local_filename)
+    if num_bytes is not None and file_stats.st_size != num_bytes:
+        raise ValueError("Unexpected size for {}: {} bytes instead of {}".format(local_filename, file_stats.st_size, num_bytes))
+    if sha256 is not None:
+        digest = file_sha256(local_filename)
+        if digest != sha256.lower():
+            raise ValueError("Checksum mismatch for {}: {} instead of {}".format(local_filename, digest, sha256))
+
+
+def file_sha256(local_filename, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(local_filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _join_url(base, filename):
+    if os.path.isdir(base):
+        return os.path.join(base, filename)
+    return base if base.endswith(filename) else base.rstrip('/') + '/' + filename
+
+
+def _fetch(base, filename, part_file, num_connections):
+    source = _join_url(base, filename)
+
+    # Local mirror directories and file:// URLs are plain copies
+    if os.path.isdir(base) or source.startswith('file://'):
+        path = url2pathname(urlparse(source).path) if source.startswith('file://') else source
+        shutil.copyfile(path, part_file)
+        _clear_state(part_file)
+        return
+
+    total, accepts_ranges = _probe(source)
+    if not accepts_ranges or total is None:
+        # The server can only send the whole file, so start over
+        _clear_state(part_file)
+        with tqdm(unit='B', unit_scale=True, miniters=1, desc=filename, total=total) as t:
+            response = urlopen(source)
+            length = response.headers.get('Content-Length')
+            expected = total if total is not None else (int(length) if length else None)
+            with open(part_file, 'wb') as f:
+                written = _copy_stream(response, f, t)
+        # A dropped connection just ends the stream, so only the byte count tells it apart
+        if expected is not None and written != expected:
+            raise IOError("Short read for {}: {} of {} bytes".format(source, written, expected))
+        return
 
-  def inner(b=1, bsize=1, tsize=None):
+    _fetch_pieces(source, part_file, total, num_connections, filename)
+
+
+def _probe(source):
+    """Returns (total size or None, whether the server honours range requests)."""
+    response = urlopen(Request(source, headers={'Range': 'bytes=0-0'}))
+    try:
+        content_range = response.headers.get('Content-Range')
+        if response.getcode() == 206 and content_range and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            return (int(total) if total.isdigit() else None), True
+        length = response.headers.get('Content-Length')
+        return (int(length) if length else None), False
+    finally:
+        response.close()
+
+
+def _fetch_pieces(source, part_file, total, num_connections, desc, piece_size=8 << 20):
     """
-    b: int, optional
-        Number of blocks just transferred [default: 1].
-    bsize: int, optional
-        Size of each block (in tqdm units) [default: 1].
-    tsize: int, optional
-        Total size (in tqdm units). If [default: None] remains unchanged.
+    Download source in fixed-size pieces over num_connections parallel range
+    requests. Finished pieces are recorded in <part_file>.json, so a later call
+    only fetches the pieces that are still missing.
     """
-    if tsize is not None:
-        t.total = tsize
-    t.update((b - last_b[0]) * bsize)
-    last_b[0] = b
-  return inner
+    state = _load_state(part_file)
+    if state.get('total') != total or state.get('piece_size') != piece_size or not os.path.exists(part_file):
+        state = {'total': total, 'piece_size': piece_size, 'done': []}
+        with open(part_file, 'wb') as f:
+            f.truncate(total)
+        _save_state(part_file, state)
+
+    done = set(state['done'])
+    pieces = [start for start in range(0, total, piece_size) if start not in done]
+    lock = threading.Lock()
+
+    with tqdm(unit='B', unit_scale=True, miniters=1, desc=desc, total=total,
+              initial=min(total, len(done) * piece_size)) as t:
+        fd = os.open(part_file, os.O_WRONLY)
+
+        def fetch(start):
+            end = min(total, start + piece_size) - 1
+            response = urlopen(Request(source, headers={'Range': 'bytes=%d-%d' % (start, end)}))
+            if response.getcode() != 206:
+                raise IOError("Server ignored the range request for bytes {}-{}".format(start, end))
+            offset = start
+            for block in iter(lambda: response.read(1 << 16), b''):
+                os.pwrite(fd, block, offset)
+                offset += len(block)
+                t.update(len(block))
+            if offset != end + 1:
+                raise IOError("Short read for bytes {}-{}".format(start, end))
+            with lock:
+                done.add(start)
+                state['done'] = sorted(done)
+                _save_state(part_file, state)
 
-def maybe_download(url, filename, prefix, num_bytes=None):
-    """Takes an URL, a filename, and the expected bytes, download
-    the contents and returns the filename
-    num_bytes=None disables the file size check."""
-    local_filename = None
-    if not os.path.exists(os.path.join(prefix, filename)):
         try:
-            print("Downloading file {}...".format(url + filename))
-            with tqdm(unit='B', unit_scale=True, miniters=1, desc=filename) as t:
-                local_filename, _ = urlretrieve(url + filename, os.path.join(prefix,filename), reporthook=reporthook(t))
-        except AttributeError as e:
-            print("An error occurred when downloading the file! Please get the dataset using a browser.")
-            raise e
-    # We have a downloaded file
-    # Check the stats and make sure they are ok
-    file_stats = os.stat(os.path.join(prefix,filename))
-    if num_bytes is None or file_stats.st_size == num_bytes:
-        print("File {} successfully loaded".format(filename))
-    else:
-        raise Exception("Unexpected dataset size. Please get the dataset using a browser.")
+            if num_connections > 1:
+                pool = ThreadPool(num_connections)
+                try:
+                    pool.map(fetch, pieces)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for start in pieces:
+                    fetch(start)
+        finally:
+            os.close(fd)
+    _clear_state(part_file)
+
+
+def _copy_stream(response, f, t, block_size=1 << 16):
+    written = 0
+    for block in iter(lambda: response.read(block_size), b''):
+        f.write(block)
+        t.update(len(block))
+        written += len(block)
+    return written
+
+
+def _load_state(part_file):
+    try:
+        with open(part_file + '.json') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_state(part_file, state):
+    with open(part_file + '.json', 'w') as f:
+        json.dump(state, f)
+
 
-    return local_filename
+def _clear_state(part_file):
+    if os.path.exists(part_file + '.json'):
+        os.remove(part_file + '.json')
@@ -0,0 +1,16 @@
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_utils import pack_tiny_imagenet
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode tiny-imagenet once into memory-mappable .npy files")
+    parser.add_argument("--data_dir", default=os.path.join("data", "tiny-imagenet-200"), help="tiny-imagenet directory, or the downloaded zip file")
+    parser.add_argument("--packed_dir", default=None, help="Where to write the packed dataset (default: {data_dir}/packed)")
+    parser.add_argument("--num_workers", type=int, default=0, help="Decoding processes (default: one per core)")
+    args = parser.parse_args()
+
+    pack_tiny_imagenet(args.data_dir, args.packed_dir, args.num_workers)
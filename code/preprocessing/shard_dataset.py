@@ -0,0 +1,20 @@
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shards import write_tiny_imagenet_shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the tiny-imagenet training images as fixed-size shards with an index")
+    parser.add_argument("--data_dir", default=os.path.join("data", "tiny-imagenet-200"), help="tiny-imagenet directory, or the downloaded zip file")
+    parser.add_argument("--shard_dir", default=None, help="Where to write the shards (default: {data_dir}/shards)")
+    parser.add_argument("--images_per_shard", type=int, default=10000, help="Records per shard file")
+    parser.add_argument("--include_val", action="store_true", help="Also shard the validation images (train+val union)")
+    parser.add_argument("--encoded", action="store_true", help="Store the JPEG bytes instead of decoded uint8 images")
+    parser.add_argument("--num_workers", type=int, default=0, help="Decoding processes (default: one per core)")
+    args = parser.parse_args()
+
+    write_tiny_imagenet_shards(args.data_dir, args.shard_dir, args.include_val, args.images_per_shard,
+                               args.encoded, args.num_workers)
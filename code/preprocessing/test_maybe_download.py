@@ -0,0 +1,145 @@
+"""
+Tests for maybe_download against a local stand-in HTTP server.
+
+    python -m unittest preprocessing.test_maybe_download     (from code/)
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from preprocessing.maybe_download import maybe_download
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Serves server.data; behaviour is switched by attributes of the server """
+
+    def do_GET(self):
+        server = self.server
+        data = server.data
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        with server.lock:
+            server.requests.append(match.groups() if match else None)
+
+        if match and server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start in server.fail_starts:
+                self.send_error(500)
+                return
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.truncate is not None and len(body) > 1:
+            # Drop the connection part way through the body
+            body = body[:server.truncate]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MaybeDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.fail_starts = set()
+        self.server.truncate = None
+        self.set_data(os.urandom(1000))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def set_data(self, data):
+        self.server.data = data
+        self.sha256 = hashlib.sha256(data).hexdigest()
+
+    def download(self, **kwargs):
+        return maybe_download(self.url, 'data.zip', self.tmp, num_bytes=len(self.server.data),
+                              sha256=self.sha256, **kwargs)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_parallel_range_download(self):
+        self.set_data(os.urandom(20 << 20))
+        filename = self.download(num_connections=3)
+        self.assertEqual(self.read(filename), self.server.data)
+        self.assertFalse(os.path.exists(filename + '.part.json'))
+
+    def test_resume_fetches_only_missing_pieces(self):
+        self.set_data(os.urandom(20 << 20))
+        self.server.fail_starts = {8 << 20}
+        with self.assertRaises(IOError):
+            self.download()
+        part_file = os.path.join(self.tmp, 'data.zip.part')
+        with open(part_file + '.json') as f:
+            self.assertEqual(json.load(f)['done'], [0])
+
+        self.server.fail_starts = set()
+        del self.server.requests[:]
+        filename = self.download()
+        self.assertEqual(self.read(filename), self.server.data)
+        fetched = [int(r[0]) for r in self.server.requests if r is not None and r[1] != '0']
+        self.assertEqual(sorted(fetched), [8 << 20, 16 << 20])
+
+    def test_short_read_without_ranges(self):
+        self.server.ranges = False
+        self.server.truncate = 300
+        with self.assertRaises(IOError):
+            maybe_download(self.url, 'data.zip', self.tmp)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'data.zip')))
+
+    def test_short_read_with_ranges(self):
+        self.server.truncate = 300
+        with self.assertRaises(IOError):
+            maybe_download(self.url, 'data.zip', self.tmp)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'data.zip')))
+
+    def test_checksum_mismatch(self):
+        self.sha256 = hashlib.sha256(b'something else').hexdigest()
+        with self.assertRaises(ValueError):
+            self.download()
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'data.zip')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'data.zip.part')))
+
+    def test_local_mirror(self):
+        mirror = os.path.join(self.tmp, 'mirror')
+        os.makedirs(mirror)
+        with open(os.path.join(mirror, 'data.zip'), 'wb') as f:
+            f.write(self.server.data)
+        filename = self.download(mirrors=[mirror])
+        self.assertEqual(self.read(filename), self.server.data)
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+On-disk store of per-model softmax scores, so ensembles only run inference
+for the models and images they have not seen before.
+
+Scores are kept per checkpoint and split as a float32 .npy file that is read
+back memory-mapped:
+
+    <cache_dir>/<checkpoint hash>/<split>.npy          (N, n_classes) scores
+    <cache_dir>/<checkpoint hash>/<split>.json         image names of the rows
+    <cache_dir>/checkpoints.json                       checkpoint path -> hash
+
+The hash is the sha256 of the checkpoint's variable files, so a snapshot that
+is retrained under the same path gets new entries, and a copied or renamed
+checkpoint reuses the old ones. Hashes are remembered together with the file
+sizes and modification times and only recomputed when those change.
+"""
+from __future__ import print_function
+
+import glob
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+
+
+def checkpoint_files(checkpoint):
+    """ The variable files of a checkpoint prefix (V2 .index/.data-* or a V1 file) """
+    files = sorted(glob.glob(checkpoint + '.index') + glob.glob(checkpoint + '.data-*'))
+    if not files and os.path.exists(checkpoint):
+        files = [checkpoint]
+    if not files:
+        raise IOError("No checkpoint files for %s" % checkpoint)
+    return files
+
+
+def _write_json(filename, obj):
+    tmp = filename + '.tmp'
+    with io.open(tmp, 'w') as f:
+        f.write(json.dumps(obj, indent=1))
+    os.rename(tmp, filename)
+
+
+class ScoreCache(object):
+    """
+    scores = cache.get_or_compute(checkpoint, "test", names, compute)
+
+    returns the (len(names), n_classes) scores of checkpoint for the images
+    names, in that order. compute(indices) is only called for the images that
+    are not cached yet, with their positions in names, and must return their
+    scores; the result is merged into the store.
+
+    Splits are just names: anything that changes the scores for the same
+    checkpoint and images, like test-time augmentation settings, should be
+    part of the split name (see split_name).
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._index_file = os.path.join(self.cache_dir, 'checkpoints.json')
+        self._index = {}
+        if os.path.exists(self._index_file):
+            with io.open(self._index_file, 'r') as f:
+                self._index = json.load(f)
+
+
+    def checkpoint_hash(self, checkpoint):
+        checkpoint = os.path.abspath(checkpoint)
+        files = checkpoint_files(checkpoint)
+        signature = [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+        entry = self._index.get(checkpoint)
+        if entry is not None and entry['files'] == signature:
+            return entry['sha256']
+
+        sha = hashlib.sha256()
+        for filename in files:
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        self._index[checkpoint] = {'files': signature, 'sha256': sha.hexdigest()}
+        _write_json(self._index_file, self._index)
+        return sha.hexdigest()
+
+
+    def _paths(self, checkpoint, split):
+        directory = os.path.join(self.cache_dir, self.checkpoint_hash(checkpoint)[:16])
+        return directory, os.path.join(directory, split + '.npy'), os.path.join(directory, split + '.json')
+
+
+    def load(self, checkpoint, split):
+        """ (names, memory-mapped scores) stored for checkpoint and split, or (None, None) """
+        _, scores_file, names_file = self._paths(checkpoint, split)
+        if not (os.path.exists(scores_file) and os.path.exists(names_file)):
+            return None, None
+        with io.open(names_file, 'r') as f:
+            names = json.load(f)['names']
+        return names, np.load(scores_file, mmap_mode='r')
+
+
+    def save(self, checkpoint, split, names, scores):
+        directory, scores_file, names_file = self._paths(checkpoint, split)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Scores first, names last: the names file marks a complete entry
+        tmp = scores_file + '.tmp.npy'
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=scores.shape)
+        out[:] = scores
+        out.flush()
+        del out
+        os.rename(tmp, scores_file)
+        _write_json(names_file, {'checkpoint': os.path.abspath(checkpoint), 'split': split, 'names': list(names)})
+
+
+    def missing(self, checkpoint, split, names):
+        """ Positions in names of the images without cached scores, as passed to compute by get_or_compute """
+        cached_names, _ = self.load(checkpoint, split)
+        cached = set(cached_names or [])
+        return [i for i, name in enumerate(names) if name not in cached]
+
+
+    def get_or_compute(self, checkpoint, split, names, compute):
+        names = list(names)
+        cached_names, cached_scores = self.load(checkpoint, split)
+        if cached_names == names:
+            return cached_scores
+
+        row = {name: i for i, name in enumerate(cached_names or [])}
+        missing = [i for i, name in enumerate(names) if name not in row]
+        new_scores = compute(missing) if missing else None
+
+        n_classes = (cached_scores if cached_scores is not None else new_scores).shape[1]
+        scores = np.empty((len(names), n_classes), dtype=np.float32)
+        if missing:
+            scores[missing] = new_scores
+        hits = [i for i, name in enumerate(names) if name in row]
+        if hits:
+            scores[hits] = cached_scores[[row[names[i]] for i in hits]]
+        if not missing:
+            return scores
+
+        # Keep what was cached before, plus the new rows
+        requested = set(names)
+        extra = [name for name in (cached_names or []) if name not in requested]
+        all_names = names + extra
+        all_scores = scores if not extra else np.concatenate([scores, cached_scores[[row[name] for name in extra]]])
+        self.save(checkpoint, split, all_names, all_scores)
+        return scores
+
+
+def split_name(split, tta_threshold=0.0, tta_gate="max_prob", augment=True):
+    """ Cache split name that also identifies the test-time augmentation used """
+    if not augment:
+        return split + '-nocrop'
+    if tta_threshold > 0:
+        return '%s-%s%g' % (split, tta_gate, tta_threshold)
+    return split
@@ -0,0 +1,325 @@
+"""
+Local prediction server for a trained model.
+
+Loads the checkpoint once and answers HTTP requests from other local
+processes. Requests that arrive at the same time are coalesced into one
+micro-batch (up to --max_batch images, waiting at most --max_wait_ms for more
+to arrive), so a busy server runs few large session.run calls instead of many
+small ones.
+
+    POST /predict[?top_k=5]   body is one of
+                                - an encoded image (JPEG, PNG, ...)
+                                - an .npy uint8 array, (64, 64, 3) or (N, 64, 64, 3)
+                                  (Content-Type: application/x-npy)
+                                - JSON {"images": [base64 encoded images], "top_k": 5}
+                              returns {"predictions": [[{"wnid", "name", "prob"}, ...], ...]}
+                              with one list of top-k classes per image
+    GET  /metrics             latency percentiles, batch sizes and queue depth
+    GET  /health
+
+Start with e.g.
+    python serve.py --classifier=DemoClassifier --train_dir=train/DemoClassifier
+and benchmark with loadgen.py.
+"""
+from __future__ import print_function
+
+import base64
+import io
+import json
+import logging
+import threading
+import time
+from collections import deque
+from os.path import join as pjoin
+
+import numpy as np
+from six.moves import queue, BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+import tensorflow as tf
+
+from ti_model import Model
+from ti_classifiers import get_classifier
+from utils import initialize_model
+from data_utils import decode_image, load_normalization, load_train_stats, load_wnids
+
+logging.basicConfig(level=logging.INFO)
+
+# Hyperparams
+tf.app.flags.DEFINE_float("learning_rate", 0.0005, "Learning rate.")
+tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
+tf.app.flags.DEFINE_integer("batch_size", 256, "Batch size to use during training.")
+tf.app.flags.DEFINE_string("optimizer", "adam", "The name of the classifier to use. For easily switching between classifiers.")
+tf.app.flags.DEFINE_float("weight_decay", 0.0001, "Weight decay coefficient, some models may not use this")
+
+# Convenience
+tf.app.flags.DEFINE_string("classifier", "DemoClassifier", "The name of the classifier to use. For easily switching between classifiers.")
+tf.app.flags.DEFINE_string("data_dir", "data/tiny-imagenet-200", "tiny-imagenet directory, zip or packed cache, for the class names (default ./data/tiny-imagenet-200)")
+tf.app.flags.DEFINE_string("train_dir", "", "Training directory to load the model parameters from (default: ./train/classifier).")
+tf.app.flags.DEFINE_bool("augment", True, "Whether or not the model was trained with data augmentation (10-crop scoring)")
+tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
+tf.app.flags.DEFINE_float("tta_threshold", 0.0, "Adaptive test-time augmentation: score all 10 crops only for images whose center crop confidence is below this (0: always all 10).")
+tf.app.flags.DEFINE_string("tta_gate", "max_prob", "Confidence used by --tta_threshold: max_prob (highest probability) or margin (highest minus second highest).")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding the training images when there is neither a normalization.npz nor a packed dataset (0: one per core).")
+
+# Serving
+tf.app.flags.DEFINE_string("host", "127.0.0.1", "Address to listen on.")
+tf.app.flags.DEFINE_integer("port", 8000, "Port to listen on.")
+tf.app.flags.DEFINE_integer("max_batch", 64, "Max number of images scored together in one micro-batch.")
+tf.app.flags.DEFINE_float("max_wait_ms", 5.0, "Max time the first request of a micro-batch waits for others to join it.")
+tf.app.flags.DEFINE_integer("top_k", 5, "Default number of classes returned per image.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class LatencyStats(object):
+    """ Percentiles over the last window recorded durations (in seconds) """
+
+    def __init__(self, window=10000):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        with self._lock:
+            values = np.array(self._values)
+        if len(values) == 0:
+            return {'count': self.count}
+        p50, p90, p99 = 1000 * np.percentile(values, [50, 90, 99])
+        return {'count': self.count, 'mean_ms': 1000 * values.mean(), 'p50_ms': p50, 'p90_ms': p90,
+                'p99_ms': p99, 'max_ms': 1000 * values.max()}
+
+
+class _Request(object):
+    def __init__(self, images):
+        self.images = images
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Runs predict(images) -> scores on one background thread, for micro-batches
+    of the images submitted by any number of threads. The first waiting request
+    starts a batch; others join it until it holds at least max_batch images or max_wait
+    seconds have passed. A request is never split, so a single request larger
+    than max_batch is run on its own.
+    """
+
+    def __init__(self, predict, max_batch=64, max_wait=0.005):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._pending_images = 0
+        self._lock = threading.Lock()
+
+        self.request_latency = LatencyStats()
+        self.queue_latency = LatencyStats()
+        self.batch_latency = LatencyStats()
+        self.num_batches = 0
+        self.num_images = 0
+        self.max_queue_depth = 0
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, images):
+        """ Scores of images (N, H, W, C), blocks until they are computed """
+        request = _Request(images)
+        with self._lock:
+            self._pending_images += len(images)
+            self.max_queue_depth = max(self.max_queue_depth, self._pending_images)
+        self._queue.put(request)
+        request.done.wait()
+        self.request_latency.record(time.time() - request.submitted)
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        num_images = len(batch[0].images)
+        deadline = time.time() + self.max_wait
+        while num_images < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_images += len(request.images)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            start = time.time()
+            for request in batch:
+                self.queue_latency.record(start - request.submitted)
+            sizes = [len(request.images) for request in batch]
+            with self._lock:
+                self._pending_images -= sum(sizes)
+
+            try:
+                scores = self.predict(np.concatenate([request.images for request in batch]))
+                for request, request_scores in zip(batch, np.split(scores, np.cumsum(sizes)[:-1])):
+                    request.scores = request_scores
+            except Exception as e:
+                logging.exception("Prediction failed")
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+            self.batch_latency.record(time.time() - start)
+            self.num_batches += 1
+            self.num_images += sum(sizes)
+
+    def metrics(self):
+        with self._lock:
+            queue_depth = self._pending_images
+        return {
+            'requests': self.request_latency.summary(),
+            'queue_wait': self.queue_latency.summary(),
+            'batches': self.batch_latency.summary(),
+            'images': self.num_images,
+            'mean_batch_size': self.num_images / float(max(1, self.num_batches)),
+            'queue_depth_images': queue_depth,
+            'max_queue_depth_images': self.max_queue_depth,
+            'max_batch': self.max_batch,
+            'max_wait_ms': 1000 * self.max_wait,
+        }
+
+
+def top_k_predictions(scores, k, wnids, class_names):
+    k = min(k, scores.shape[1])
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [[{'wnid': wnids[c], 'name': class_names[c][0], 'prob': float(s[c])} for c in row]
+            for row, s in zip(top, scores)]
+
+
+def parse_images(body, content_type):
+    """ (N, 64, 64, 3) uint8 images and the top_k asked for (or None) from a request body """
+    if content_type.startswith('application/x-npy'):
+        images = np.load(io.BytesIO(body), allow_pickle=False)
+        return (images[None] if images.ndim == 3 else images).astype(np.uint8), None
+    if content_type.startswith('application/json'):
+        request = json.loads(body.decode('utf-8'))
+        images = [decode_image(base64.b64decode(image)) for image in request['images']]
+        return np.stack(images) if images else np.zeros((0, 64, 64, 3), np.uint8), request.get('top_k')
+    return decode_image(body)[None], None
+
+
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._reply(200, self.server.batcher.metrics())
+        elif path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'unknown path %s' % path})
+
+    def do_POST(self):
+        start = time.time()
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._reply(404, {'error': 'unknown path %s' % url.path})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            images, top_k = parse_images(body, self.headers.get('Content-Type', ''))
+            if len(images) == 0:
+                raise ValueError("no images in the request")
+            if images.shape[1:] != (64, 64, 3):
+                raise ValueError("images must be 64x64x3, got %s" % (images.shape[1:],))
+            top_k = int(parse_qs(url.query).get('top_k', [top_k or FLAGS.top_k])[0])
+        except Exception as e:
+            self._reply(400, {'error': str(e)})
+            return
+
+        try:
+            scores = self.server.batcher.submit(images)
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {
+            'predictions': top_k_predictions(scores, top_k, self.server.wnids, self.server.class_names),
+            'latency_ms': 1000 * (time.time() - start),
+        })
+
+    def log_message(self, format, *args):
+        pass   # One line per request would drown everything else
+
+
+class PredictionServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128   # The default of 5 makes concurrent clients wait for connection retries
+
+    def __init__(self, address, batcher, wnids, class_names):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PredictionHandler)
+        self.batcher = batcher
+        self.wnids = wnids
+        self.class_names = class_names
+
+
+def main(_):
+    if FLAGS.train_dir == "":
+        FLAGS.train_dir = pjoin("train", FLAGS.classifier)
+
+    wnids, class_names = load_wnids(FLAGS.data_dir)
+    normalization = load_normalization(FLAGS.train_dir)
+    if normalization is None:
+        logging.warning("No normalization.npz in %s, recomputing the statistics from the training set" % FLAGS.train_dir)
+        normalization = load_train_stats(FLAGS.data_dir, FLAGS.num_workers).normalization()
+
+    #Store img sizes
+    jitter = 8 if FLAGS.augment else 0
+    FLAGS.img_H = 64 - jitter
+    FLAGS.img_W = 64 - jitter
+    FLAGS.img_C = 3
+
+    print ("Creating '" + FLAGS.classifier + "'")
+    classifier = get_classifier(FLAGS.classifier, FLAGS)
+
+    print ("Creating Model")
+    model = Model(classifier, FLAGS, normalization=normalization)
+
+    with tf.Session() as sess:
+        print ("train_dir: ", FLAGS.train_dir)
+        initialize_model(sess, model, FLAGS.train_dir)
+
+        def predict(images):
+            return model.crop_scores(sess, images, batch_size=max(FLAGS.max_batch, len(images)),
+                                     tta_threshold=FLAGS.tta_threshold, tta_gate=FLAGS.tta_gate)
+
+        batcher = MicroBatcher(predict, FLAGS.max_batch, FLAGS.max_wait_ms / 1000.0)
+        server = PredictionServer((FLAGS.host, FLAGS.port), batcher, wnids, class_names)
+        print ("Serving on http://%s:%d (max batch %d, max wait %g ms)" % (FLAGS.host, FLAGS.port, FLAGS.max_batch, FLAGS.max_wait_ms))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+import io
+import os
+import json
+
+import numpy as np
+from scipy.misc import imread
+from tqdm import tqdm
+
+from data_utils import ImageStats, dataset_files, _decode_images, _load_wnids, _train_files_and_labels, _val_filenames
+
+# One row per record: which shard it lives in, where, and its label
+INDEX_DTYPE = np.dtype([('shard', np.int32), ('offset', np.int64), ('length', np.int64), ('label', np.int64)])
+IMG_SHAPE = (64, 64, 3)
+
+
+def shard_filename(shard_dir, shard):
+    return os.path.join(shard_dir, 'shard-%05d.bin' % shard)
+
+
+def write_shards(img_files, labels, shard_dir, images_per_shard=10000, encoded=False, num_workers=1, files=None):
+    """
+    Write img_files into fixed-size shards under shard_dir, plus index.npy mapping
+    every global index to its (shard, offset, length, label).
+
+    With encoded=False (the default) images are decoded once and stored as raw uint8
+    records of a fixed size, which is what training wants; stats.npz then holds their
+    ImageStats. With encoded=True the original JPEG bytes are copied, which is about
+    5x smaller but has to be decoded on every read.
+    files (see data_utils.dataset_files) reads img_files from e.g. a zip archive.
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    num_records = len(img_files)
+    index = np.zeros(num_records, dtype=INDEX_DTYPE)
+    index['label'] = labels
+    stats = ImageStats(IMG_SHAPE)
+    record_size = int(np.prod(IMG_SHAPE))
+
+    num_shards = int(np.ceil(num_records / float(images_per_shard)))
+    for shard in range(num_shards):
+        start, end = shard * images_per_shard, min(num_records, (shard + 1) * images_per_shard)
+        print('writing shard %d / %d' % (shard + 1, num_shards))
+        filename = shard_filename(shard_dir, shard)
+        index['shard'][start:end] = shard
+
+        if encoded:
+            offset = 0
+            with open(filename, 'wb') as f:
+                for i in tqdm(range(start, end)):
+                    if files:
+                        data = files.read_bytes(img_files[i])
+                    else:
+                        with open(img_files[i], 'rb') as img:
+                            data = img.read()
+                    f.write(data)
+                    index['offset'][i], index['length'][i] = offset, len(data)
+                    offset += len(data)
+        else:
+            X = np.memmap(filename, dtype=np.uint8, mode='w+', shape=(end - start,) + IMG_SHAPE)
+            _decode_images(img_files[start:end], X, num_workers, stats=stats, files=files)
+            X.flush()
+            del X
+            index['offset'][start:end] = np.arange(end - start) * record_size
+            index['length'][start:end] = record_size
+
+    np.save(os.path.join(shard_dir, 'index.npy'), index)
+    if not encoded:
+        stats.save(os.path.join(shard_dir, 'stats.npz'))
+    # meta.json is written last and marks the shards as complete
+    with open(os.path.join(shard_dir, 'meta.json'), 'w') as f:
+        json.dump({'encoded': encoded, 'shape': list(IMG_SHAPE), 'num_shards': num_shards,
+                   'num_records': num_records}, f)
+    print('Wrote %d images in %d shards to %s' % (num_records, num_shards, shard_dir))
+    return shard_dir
+
+
+def write_tiny_imagenet_shards(path, shard_dir=None, include_val=False, images_per_shard=10000,
+                               encoded=False, num_workers=1):
+    """
+    Shard the train/<wnid>/images tree of TinyImageNet (default: into <path>/shards).
+    include_val adds the labelled validation images, for training on the train+val union.
+    path can also be the downloaded zip file, which is read without extracting it;
+    shard_dir must then be given.
+    """
+    files = dataset_files(path)
+    if shard_dir is None:
+        assert os.path.isdir(path), "shard_dir is required when sharding from a zip file"
+        shard_dir = os.path.join(path, 'shards')
+    wnids, _ = _load_wnids(files)
+    wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
+
+    img_files, labels = _train_files_and_labels(files, wnids, wnid_to_label)
+    if include_val:
+        val_files, val_wnids = _val_filenames(files)
+        img_files = img_files + val_files
+        labels = np.concatenate([labels, [wnid_to_label[wnid] for wnid in val_wnids]])
+
+    return write_shards(img_files, labels, shard_dir, images_per_shard, encoded, num_workers, files)
+
+
+class ShardReader(object):
+    """
+    Random access to a directory written by write_shards.
+
+    Behaves like a read-only (N, 64, 64, 3) uint8 array: len(), .shape, .dtype and
+    indexing with an int, a slice or an array of indices all work, so it can stand
+    in for X_train. A batch is served by grouping its indices per shard, and the
+    records of a shard that lie within max_gap bytes of each other are fetched with
+    a single os.pread, so a contiguous range costs one read per shard.
+    """
+    def __init__(self, shard_dir, max_gap=1 << 20):
+        self.shard_dir = shard_dir
+        self.max_gap = max_gap
+        with open(os.path.join(shard_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(shard_dir, 'index.npy'))
+        self.labels = self.index['label']
+        self.shape = (len(self.index),) + tuple(self.meta['shape'])
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = len(self.shape)
+        self._fds, self._pid = {}, None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.read([key])[0]
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        return self.read(key)
+
+    def _fd(self, shard):
+        # File descriptors are not shared with forked workers
+        if self._pid != os.getpid():
+            self._fds, self._pid = {}, os.getpid()
+        if shard not in self._fds:
+            self._fds[shard] = os.open(shard_filename(self.shard_dir, shard), os.O_RDONLY)
+        return self._fds[shard]
+
+    def close(self):
+        if self._pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+        self._fds = {}
+
+    def read(self, indices, out=None):
+        """
+        Returns the images at indices (in that order) as an (n, 64, 64, 3) uint8 array,
+        written into out if it is given.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(indices),) + self.shape[1:], dtype=np.uint8)
+        records = self.index[indices]
+
+        # Visit every shard once, in offset order
+        order = np.lexsort((records['offset'], records['shard']))
+        runs_start = np.ones(len(order), dtype=bool)
+        sorted_records = records[order]
+        if len(order) > 1:
+            gap = sorted_records['offset'][1:] - (sorted_records['offset'][:-1] + sorted_records['length'][:-1])
+            runs_start[1:] = (sorted_records['shard'][1:] != sorted_records['shard'][:-1]) | (gap > self.max_gap)
+        bounds = np.append(np.flatnonzero(runs_start), len(order))
+
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            run = sorted_records[a:b]
+            lo = run['offset'][0]
+            hi = (run['offset'] + run['length']).max()
+            buf = os.pread(self._fd(int(run['shard'][0])), int(hi - lo), int(lo))
+            self._decode_run(buf, run, lo, out, order[a:b])
+        return out
+
+    def _decode_run(self, buf, run, lo, out, positions):
+        if not self.meta['encoded']:
+            # Raw records are a fixed size, so the whole run is one strided array
+            record_size = int(np.prod(self.shape[1:]))
+            X = np.frombuffer(buf, dtype=np.uint8).reshape((-1,) + self.shape[1:])
+            out[positions] = X[(run['offset'] - lo) // record_size]
+            return
+        for pos, offset, length in zip(positions, run['offset'], run['length']):
+            img = imread(io.BytesIO(buf[offset - lo:offset - lo + length]))
+            if img.ndim == 2:
+                img = img[:, :, None]
+            out[pos] = img
+
+    def iter_shards(self):
+        """
+        Yields (X, y) for one whole shard at a time, each read with a single pread.
+        """
+        for shard in range(self.meta['num_shards']):
+            indices = np.flatnonzero(self.index['shard'] == shard)
+            yield self.read(indices), self.labels[indices]
+
+    def stats(self):
+        """
+        The ImageStats of every image, from stats.npz or else computed shard by shard.
+        """
+        stats_file = os.path.join(self.shard_dir, 'stats.npz')
+        if os.path.exists(stats_file):
+            return ImageStats.load(stats_file)
+        stats = ImageStats(self.shape[1:])
+        for X, _ in self.iter_shards():
+            stats.update(X)
+        return stats
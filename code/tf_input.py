@@ -0,0 +1,157 @@
+"""
+In-graph (tf.data) input pipeline for training.
+
+Instead of feeding every batch through the X/y placeholders, the training
+images are served by a tf.data pipeline that shuffles, normalizes, crops,
+flips and batches inside the TensorFlow runtime and prefetches ahead of the
+training step. Model uses the iterator tensors as the defaults of its X/y
+placeholders, so score/crop_classify can still feed images as before.
+
+Two sources are supported:
+    - memory: the training arrays are copied once into a (non-saved) variable
+      and each epoch is a full random permutation of them.
+    - packed: the uint8 X_train.npy of the packed cache (see
+      data_utils.pack_tiny_imagenet) is read straight from disk in blocks of
+      consecutive images; blocks are visited in random order, interleaved
+      and passed through a shuffle buffer.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def npy_header_size(filename):
+    """ Number of bytes before the array data of a .npy file """
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+
+class TrainInput(object):
+    """
+    tf.data pipeline over (X_train, y_train). build() creates the iterator and
+    returns the (images, labels) batch tensors; initialize() must be run once
+    in the session before the first step. The pipeline repeats forever, an
+    epoch is num_batches steps.
+
+    :param X, y: training arrays. X is only used for its shape and, without
+                 packed_dir, its contents.
+    :param packed_dir: read the uint8 images from <packed_dir>/X_train.npy instead
+                       of from X (the first len(y) images are used)
+    :param normalization: dict as returned by data_utils.ImageStats.normalization,
+                          applied in the graph (None if X is already normalized)
+    """
+
+    def __init__(self, FLAGS, X, y, packed_dir=None, normalization=None,
+                 shuffle_buffer=10000, block_size=128, cycle_length=64):
+        self.FLAGS = FLAGS
+        self.X = X
+        self.y = np.asarray(y, dtype=np.int64)
+        self.packed_dir = packed_dir
+        self.normalization = normalization
+        self.shuffle_buffer = shuffle_buffer
+        self.block_size = block_size
+        self.cycle_length = cycle_length
+        self.num_data = len(self.y)
+        self.num_batches = int(math.ceil(self.num_data / float(FLAGS.batch_size)))
+        self.img_shape = tuple(X.shape[1:])
+        self._init_feed = {}
+
+
+    def build(self):
+        with tf.name_scope("train_input"):
+            if self.packed_dir is None:
+                dataset = self._memory_dataset()
+            else:
+                dataset = self._packed_dataset()
+
+            num_parallel_calls = max(1, self.FLAGS.prefetch_workers)
+            dataset = dataset.map(self._prepare, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.batch(self.FLAGS.batch_size)
+            dataset = dataset.prefetch(max(1, self.FLAGS.prefetch_depth))
+
+            self.iterator = dataset.make_initializable_iterator()
+            return self.iterator.get_next()
+
+
+    def initialize(self, session):
+        session.run(self._initializers, feed_dict=self._init_feed)
+
+
+    def _memory_dataset(self):
+        # Preloaded variable pattern: the arrays go into the runtime once through
+        # placeholders and stay out of the graph definition and the checkpoints
+        X_init = tf.placeholder(tf.as_dtype(self.X.dtype), self.X.shape)
+        y_init = tf.placeholder(tf.int64, self.y.shape)
+        X_var = tf.Variable(X_init, trainable=False, collections=[], name="X_train")
+        y_var = tf.Variable(y_init, trainable=False, collections=[], name="y_train")
+        self._init_feed = {X_init: self.X, y_init: self.y}
+
+        dataset = tf.data.Dataset.range(self.num_data)
+        dataset = dataset.shuffle(self.num_data).repeat()
+        dataset = dataset.map(lambda i: (tf.gather(X_var, i), tf.gather(y_var, i)))
+        self._dataset_initializers = [X_var.initializer, y_var.initializer]
+        return dataset
+
+
+    def _packed_dataset(self):
+        filename = os.path.join(self.packed_dir, 'X_train.npy')
+        header_bytes = npy_header_size(filename)
+        record_bytes = int(np.prod(self.img_shape))
+        file_bytes = os.path.getsize(filename)
+        labels = tf.constant(self.y)
+
+        starts = np.arange(0, self.num_data, self.block_size, dtype=np.int64)
+        counts = np.minimum(self.block_size, self.num_data - starts)
+
+        def read_block(start, count):
+            # Header and footer select one block of consecutive records of the file
+            images = tf.data.FixedLengthRecordDataset(
+                filename, record_bytes,
+                header_bytes=header_bytes + start * record_bytes,
+                footer_bytes=file_bytes - header_bytes - (start + count) * record_bytes)
+            images = images.map(lambda record: tf.reshape(tf.decode_raw(record, tf.uint8), self.img_shape))
+            block_labels = tf.data.Dataset.from_tensor_slices(labels[start:start + count])
+            return tf.data.Dataset.zip((images, block_labels))
+
+        dataset = tf.data.Dataset.from_tensor_slices((starts, counts))
+        dataset = dataset.shuffle(len(starts)).repeat()
+        dataset = dataset.interleave(read_block, cycle_length=self.cycle_length, block_length=1)
+        dataset = dataset.shuffle(self.shuffle_buffer)
+        self._dataset_initializers = []
+        return dataset
+
+
+    @property
+    def _initializers(self):
+        return self._dataset_initializers + [self.iterator.initializer]
+
+
+    def _prepare(self, image, label):
+        """ In-graph version of Model.prepare_batch for one image """
+        image = tf.cast(image, tf.float32)
+        if self.normalization is not None:
+            image = image - self.normalization['mean'].astype(np.float32)
+            if 'std' in self.normalization:
+                image = image / self.normalization['std'].astype(np.float32)
+
+        if self.FLAGS.augment:
+            image = tf.random_crop(image, [self.FLAGS.img_H, self.FLAGS.img_W, self.FLAGS.img_C])
+            image = tf.image.random_flip_left_right(image)
+            if self.FLAGS.jitter_contrast > 0:
+                mean = tf.reduce_mean(image)
+                factor = tf.random_uniform([], 1 - self.FLAGS.jitter_contrast, 1 + self.FLAGS.jitter_contrast)
+                image = (image - mean) * factor + mean
+            if self.FLAGS.jitter_brightness > 0:
+                image = image + tf.random_uniform([], -self.FLAGS.jitter_brightness, self.FLAGS.jitter_brightness)
+        return image, label
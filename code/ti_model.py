@@ -9,6 +9,7 @@ import copy
 import random
 import sys
 import math
+import threading
 from datetime import datetime
 
 import numpy as np
@@ -17,71 +18,46 @@ import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops.nn import sparse_softmax_cross_entropy_with_logits
 
-from utils import get_batches
-from data_utils import augment_batch, crop_10
+from utils import batch_indices, count_batches, gather
+from pipeline import BatchPrefetcher
+from data_utils import augment_batch, crop_10, crop_10_views, normalize_batch, save_normalization
 from lrmanager import lrManager
 
 logging.basicConfig(level=logging.INFO)
 
+CENTER_CROP = 8   # Index of the unflipped center crop in data_utils.crop_10_views
 
-class Model(object):
-    def __init__(self, classifier, FLAGS, *args):
-        """
-        Initializes your System
-        :param classifier: an image classifier that you constructed in train.py
-        :param args: pass in more arguments as needed
-        """
-        self.classifier = classifier
-        self.FLAGS = FLAGS
-        self.current_lr =  self.FLAGS.learning_rate
-
-        # ==== set up variables ========
-        # self.learning_rate = tf.Variable(float(self.FLAGS.learning_rate), trainable = False, name = "learning_rate")
-        self.global_step = tf.Variable(int(0), trainable = False, name = "global_step")
-
-        # # ==== set up placeholder tokens ======== 3d (because of batching)
-        self.learning_rate = tf.placeholder(tf.float32, name = "learning_rate")
-        self.X = tf.placeholder(tf.float32, [None, FLAGS.img_H, FLAGS.img_W, FLAGS.img_C], name="X")
-        self.y = tf.placeholder(tf.int64, [None], name="y")
-        self.is_training = tf.placeholder(tf.bool, name="is_training")
-
-        # ==== assemble pieces ====
-        with tf.variable_scope("model"):
-            self.setup_system()
-            self.setup_loss()
-            self.setup_training_procedure()
-
-        # ==== setup saver ====
-        self.saver = tf.train.Saver(tf.global_variables())
-
-
-    def setup_system(self):
-        with vs.variable_scope("classify"):
-            raw_scores = self.classifier.forward_pass(self.X, self.is_training)
-            self.y_out = tf.nn.softmax(raw_scores, name = "softmax")    # Apply softmax to raw output scores
-
-            with tf.name_scope('y_out_summaries'):
-                mean = tf.reduce_mean(self.y_out)
-                stddev = tf.sqrt(tf.reduce_mean(tf.square(self.y_out - mean)))
-                self.y_out_stddev_tb = tf.summary.scalar('stddev', stddev)
-                self.y_out_max_tb = tf.summary.scalar('max', tf.reduce_max(self.y_out))
 
+def tta_confidence(scores, gate="max_prob"):
+    """
+    Confidence of each row of softmax scores, used to decide whether an image
+    needs all 10 crops: the highest probability ("max_prob") or its margin
+    over the second highest ("margin").
+    """
+    if gate == "max_prob":
+        return np.max(scores, axis=1)
+    elif gate == "margin":
+        top2 = np.partition(scores, -2, axis=1)[:, -2:]
+        return top2[:, 1] - top2[:, 0]
+    raise ValueError("Unknown tta_gate '%s'" % gate)
 
-    def setup_loss(self):
-        with vs.variable_scope("loss"):
-            self.loss = self.classifier.loss(self.y)
-
-            self.train_loss_tb = tf.summary.scalar("train_loss", self.loss)
-            self.val_loss_tb = tf.summary.scalar("val_loss", self.loss)
 
+class InferenceModel(object):
+    """
+    Scoring and test-time augmentation shared by Model and EnsembleModel.
+    Subclasses build the graph and set self.FLAGS, self.normalization, the
+    self.X and self.is_training placeholders and the softmax output self.y_out.
+    """
 
-    def setup_training_procedure(self):
-        with vs.variable_scope("train_op"):
-            self.train_op, self.global_norm = self.classifier.train_op(self.learning_rate, self.global_step, self.loss)
+    def preprocess(self, X_batch):
+        """
+        Converts raw images to normalized float32 when the dataset was loaded without
+        normalizing. Must run before cropping, since the mean image is full size.
+        """
+        if self.normalization is None:
+            return X_batch
+        return normalize_batch(X_batch, self.normalization)
 
-            self.learning_rate_tb = tf.summary.scalar("learning_rate", self.learning_rate)
-            self.global_norm_tb = tf.summary.scalar("global_norm", self.global_norm)
-        
 
     def score(self, session, X_batch):
         """
@@ -114,14 +90,7 @@ class Model(object):
         Intended for classifying crops of the same image
         '''
         assert(image.shape[0] == 1)
-
-        if(self.FLAGS.augment):
-            crops = crop_10(image, self.FLAGS.img_H, self.FLAGS.img_W)
-        else:
-            crops = image
-
-        scores = self.score(session, crops)
-        overall_score = np.mean(scores, axis=0)
+        overall_score = self.crop_scores(session, image)[0]
 
         if raw_score:
             return overall_score
@@ -134,6 +103,77 @@ class Model(object):
             return top5pred
 
 
+    def crop_scores(self, session, X, batch_size=None, tta_threshold=0.0, tta_gate="max_prob"):
+        '''
+        NOT FOR TRAINING
+
+        Returns: (N, n_classes) softmax scores of the N images of X, each averaged
+            over its 10 crops (see data_utils.crop_10) when the model was trained
+            on crops. batch_size images (default FLAGS.batch_size) are scored per
+            session.run, i.e. 10x that many crops.
+
+        With tta_threshold > 0, only the center crop is scored first, and the other
+        9 crops are added only for the images whose tta_confidence (tta_gate) is
+        below the threshold. self.tta_stats counts the images that needed them.
+        '''
+        batch_size = batch_size or self.FLAGS.batch_size
+        adaptive = self.FLAGS.augment and tta_threshold > 0
+        scores = None
+        self.tta_stats = {'images': 0, 'expanded': 0}
+        for start in range(0, len(X), batch_size):
+            X_batch = self.preprocess(X[start:start+batch_size])
+            n = len(X_batch)
+            if adaptive:
+                batch_scores = self.adaptive_crop_scores(session, X_batch, batch_size, tta_threshold, tta_gate)
+            elif(self.FLAGS.augment):
+                crops = crop_10(X_batch, self.FLAGS.img_H, self.FLAGS.img_W, out=self.tta_buffer(X_batch, batch_size)[:10*n])
+                batch_scores = self.score(session, crops)
+                batch_scores = batch_scores.reshape(10, n, -1).mean(axis=0)
+                self.tta_stats['expanded'] += n
+            else:
+                batch_scores = self.score(session, X_batch)
+
+            if scores is None:
+                scores = np.empty((len(X), batch_scores.shape[1]), dtype=np.float32)
+            scores[start:start+n] = batch_scores
+            self.tta_stats['images'] += n
+        return scores
+
+
+    def adaptive_crop_scores(self, session, X_batch, batch_size, tta_threshold, tta_gate):
+        '''
+        NOT FOR TRAINING
+
+        Confidence-gated 10-crop scores of one preprocessed batch, see crop_scores
+        '''
+        H, W = self.FLAGS.img_H, self.FLAGS.img_W
+        scores = self.score(session, np.ascontiguousarray(crop_10_views(X_batch, H, W)[CENTER_CROP]))
+
+        uncertain = np.flatnonzero(tta_confidence(scores, tta_gate) < tta_threshold)
+        m = len(uncertain)
+        if m > 0:
+            # Score the other 9 crops of the uncertain images and fold in the center crop
+            views = crop_10_views(X_batch[uncertain], H, W)
+            crops = self.tta_buffer(X_batch, batch_size)[:9*m]
+            for k, view in enumerate(views[:CENTER_CROP] + views[CENTER_CROP+1:]):
+                crops[k*m:(k+1)*m] = view
+            other_scores = self.score(session, crops).reshape(9, m, -1).sum(axis=0)
+            scores[uncertain] = (scores[uncertain] + other_scores) / 10
+            self.tta_stats['expanded'] += m
+        return scores
+
+
+    def tta_buffer(self, X_batch, batch_size):
+        """
+        One reusable array for the crops of batch_size images, see crop_scores
+        """
+        shape = (10 * batch_size, self.FLAGS.img_H, self.FLAGS.img_W, self.FLAGS.img_C)
+        buffer = getattr(self, "_tta_buffer", None)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.dtype != X_batch.dtype:
+            self._tta_buffer = np.empty(shape, dtype=X_batch.dtype)
+        return self._tta_buffer
+
+
     def classify(self, session, X_batch):
         '''
         NOT FOR TRAINING
@@ -141,34 +181,144 @@ class Model(object):
         Returns: predicted class identifier
         '''
 
-        scores = self.score(session, X_batch)
+        scores = self.score(session, self.preprocess(X_batch))
         preds = np.argmax(scores, axis=1)
         return preds
 
 
-    def evaluate_model(self, session, dataset, sample_size=None, top5 = False):
+    def evaluate_model(self, session, X, y, sample_size=None, tta_threshold=0.0, tta_gate="max_prob"):
         """
         :param session: session should always be centrally managed in train.py
-        :param dataset: a representation of our data, in some implementations, you can
-                        pass in multiple components (arguments) of one dataset to this function
-        :param sample: how many examples in dataset we look at
-        :param log: whether we print to std out stream
-        :return: prediction accuracy
+        :param X, y: images and labels to evaluate on
+        :param sample_size: how many random examples of X we look at (default: all)
+        :param tta_threshold, tta_gate: adaptive test-time augmentation, see crop_scores
+        :return: dict with the top-1 and top-5 accuracy ('top1', 'top5') and the
+                 top-1 accuracy of every class ('per_class', nan for classes that
+                 did not occur), all from one pass of batched crop scoring
+        """
+        y = np.asarray(y)
+        if sample_size is not None and sample_size < len(y):
+            indices = np.sort(random.sample(range(len(y)), sample_size))
+            X, y = X[indices], y[indices]
+
+        scores = self.crop_scores(session, X, tta_threshold=tta_threshold, tta_gate=tta_gate)
+        top1 = np.argmax(scores, axis=1) == y
+        top5 = np.any(np.argpartition(scores, -5, axis=1)[:, -5:] == y[:, None], axis=1)
+
+        n_classes = scores.shape[1]
+        counts = np.bincount(y, minlength=n_classes)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            per_class = np.bincount(y, weights=top1, minlength=n_classes) / counts
+
+        return {
+            'top1': np.mean(top1),
+            'top5': np.mean(top5),
+            'per_class': per_class,
+        }
+
+
+
+class Model(InferenceModel):
+    def __init__(self, classifier, FLAGS, *args, normalization=None, train_input=None):
+        """
+        Initializes your System
+        :param classifier: an image classifier that you constructed in train.py
+        :param args: pass in more arguments as needed
+        :param normalization: if given, images are raw (uint8) and this normalization
+                              (see data_utils.normalize_batch) is applied per batch
+                              instead of ahead of time by the loader
+        :param train_input: optional tf_input.TrainInput. Training batches then come
+                            from its in-graph pipeline instead of feed_dict; X and y
+                            can still be fed for scoring and evaluation.
         """
-        if sample_size == None:
-            sample_size = len(dataset)
+        self.classifier = classifier
+        self.FLAGS = FLAGS
+        self.current_lr =  self.FLAGS.learning_rate
+        self.normalization = normalization
+        self.train_input = train_input
+
+        # ==== set up variables ========
+        # self.learning_rate = tf.Variable(float(self.FLAGS.learning_rate), trainable = False, name = "learning_rate")
+        self.global_step = tf.Variable(int(0), trainable = False, name = "global_step")
+
+        # # ==== set up placeholder tokens ======== 3d (because of batching)
+        self.learning_rate = tf.placeholder(tf.float32, name = "learning_rate")
+        if train_input is None:
+            self.X = tf.placeholder(tf.float32, [None, FLAGS.img_H, FLAGS.img_W, FLAGS.img_C], name="X")
+            self.y = tf.placeholder(tf.int64, [None], name="y")
+        else:
+            X_next, y_next = train_input.build()
+            self.X = tf.placeholder_with_default(X_next, [None, FLAGS.img_H, FLAGS.img_W, FLAGS.img_C], name="X")
+            self.y = tf.placeholder_with_default(y_next, [None], name="y")
+        self.is_training = tf.placeholder(tf.bool, name="is_training")
+
+        # ==== assemble pieces ====
+        with tf.variable_scope("model"):
+            self.setup_system()
+            self.setup_loss()
+            self.setup_training_procedure()
+
+        # ==== setup saver ====
+        self.saver = tf.train.Saver(tf.global_variables())
+
+
+    def setup_system(self):
+        with vs.variable_scope("classify"):
+            raw_scores = self.classifier.forward_pass(self.X, self.is_training)
+            self.y_out = tf.nn.softmax(raw_scores, name = "softmax")    # Apply softmax to raw output scores
+
+            with tf.name_scope('y_out_summaries'):
+                mean = tf.reduce_mean(self.y_out)
+                stddev = tf.sqrt(tf.reduce_mean(tf.square(self.y_out - mean)))
+                self.y_out_stddev_tb = tf.summary.scalar('stddev', stddev)
+                self.y_out_max_tb = tf.summary.scalar('max', tf.reduce_max(self.y_out))
+
+
+    def setup_loss(self):
+        with vs.variable_scope("loss"):
+            self.loss = self.classifier.loss(self.y)
+
+            self.train_loss_tb = tf.summary.scalar("train_loss", self.loss)
+            self.val_loss_tb = tf.summary.scalar("val_loss", self.loss)
+
+
+    def setup_training_procedure(self):
+        with vs.variable_scope("train_op"):
+            self.train_op, self.global_norm = self.classifier.train_op(self.learning_rate, self.global_step, self.loss)
+
+            self.learning_rate_tb = tf.summary.scalar("learning_rate", self.learning_rate)
+            self.global_norm_tb = tf.summary.scalar("global_norm", self.global_norm)
+        
 
-        eval_set = random.sample(dataset, sample_size)
+    def crop_buffer(self, X_batch):
+        """
+        One reusable array for the cropped training batches. feed_dict copies it
+        during session.run, so it is free again by the next step.
+        """
+        shape = (self.FLAGS.batch_size, self.FLAGS.img_H, self.FLAGS.img_W, self.FLAGS.img_C)
+        dtype = np.asarray(X_batch[0]).dtype
+        if getattr(self, "_crop_buffer", None) is None or self._crop_buffer.dtype != dtype:
+            self._crop_buffer = np.empty(shape, dtype=dtype)
+        return self._crop_buffer
+
+
+    def prepare_batch(self, X_batch, y_batch, reuse_buffer=True):
+        """
+        FOR TRAINING ONLY
 
-        running_sum = 0
-        for img, label in eval_set:
-            img = np.expand_dims(img, axis=0)
-            pred = self.crop_classify(session, img, top5)
-            correct_pred = np.equal(pred, label)
-            running_sum += np.sum(correct_pred)
+        Host side of a training step: normalization and augmentation. With
+        reuse_buffer=False every batch gets its own crop array, which is needed
+        when batches are prepared ahead of time on another thread.
+        :return:
+            X_batch, y_batch ready to be fed to train_step
+        """
+        X_batch = self.preprocess(X_batch)
 
-        accuracy = running_sum/sample_size
-        return accuracy
+        if(self.FLAGS.augment):
+            out = self.crop_buffer(X_batch) if reuse_buffer else None
+            X_batch = augment_batch(X_batch, self.FLAGS.img_H, self.FLAGS.img_W, out=out,
+                                    brightness=self.FLAGS.jitter_brightness, contrast=self.FLAGS.jitter_contrast)
+        return X_batch, y_batch
 
 
     def optimize(self, session, batch):
@@ -181,14 +331,25 @@ class Model(object):
             loss, global_norm, global_step
         """
         X_batch, y_batch = zip(*batch)    # Unzip batch, each returned element is a tuple of lists
+        X_batch, y_batch = self.prepare_batch(X_batch, y_batch)
+        return self.train_step(session, X_batch, y_batch)
 
-        if(self.FLAGS.augment):
-            X_batch = augment_batch(X_batch, self.FLAGS.img_H, self.FLAGS.img_W)
 
+    def train_step(self, session, X_batch, y_batch):
+        """
+        FOR TRAINING ONLY
+
+        Runs one optimizer step on a batch that already went through prepare_batch.
+        With an in-graph input pipeline, X_batch and y_batch are None and the
+        batch is taken from the pipeline.
+        :return:
+            loss, global_norm, global_step
+        """
         input_feed = {}
 
-        input_feed[self.X] = X_batch
-        input_feed[self.y] = y_batch
+        if X_batch is not None:
+            input_feed[self.X] = X_batch
+            input_feed[self.y] = y_batch
         input_feed[self.is_training] = True
         input_feed[self.learning_rate] = self.current_lr
 
@@ -254,12 +415,17 @@ class Model(object):
         checkpoint_path = os.path.join(self.FLAGS.train_dir, rname)
         early_stopping_path = os.path.join(checkpoint_path, "early_stopping")
 
+        # Keep the normalization statistics with the checkpoints so inference can skip the training set
+        if dataset.get("normalization") is not None:
+            save_normalization(checkpoint_path, dataset["normalization"])
+
         # Setup conveinient handles on train and val sets
-        train_data = list(zip(dataset["X_train"], dataset["y_train"]))
-        val_data = list(zip(dataset["X_val"], dataset["y_val"]))
+        # X_train may be a lazy view (see data_utils.AugmentedImages), so it is only indexed a batch at a time
+        X_train, y_train = dataset["X_train"], dataset["y_train"]
+        X_val, y_val = dataset["X_val"], dataset["y_val"]
 
          # Helper stuff
-        num_data = len(train_data)
+        num_data = len(y_train)
         best_val_acc = 0
         best_train_acc = 0
         rolling_ave_window = 10
@@ -268,19 +434,44 @@ class Model(object):
         # Systematic learning rate decay
         lrHelper = lrManager(self.FLAGS, num_data)
         
+        # Batches are gathered and augmented by background workers while the previous step runs.
+        # Each worker gathers into its own buffer, unless the prepared batch could still be that
+        # buffer (no augmentation or normalization copies it) while it waits in the queue
+        prefetch_workers = self.FLAGS.prefetch_workers
+        reuse_gather_buffer = prefetch_workers == 0 or self.FLAGS.augment or self.normalization is not None
+        local = threading.local()
+        def prepare(indices):
+            out = None
+            if reuse_gather_buffer and isinstance(X_train, np.ndarray):
+                if getattr(local, "buffer", None) is None:
+                    local.buffer = np.empty((self.FLAGS.batch_size,) + X_train.shape[1:], dtype=X_train.dtype)
+                out = local.buffer
+            X_batch = gather(X_train, indices, out)
+            return self.prepare_batch(X_batch, y_train[indices], reuse_buffer=(prefetch_workers == 0))
+
+        if self.train_input is not None:
+            self.train_input.initialize(session)
+
         # Epoch level loop
         step = 1
         for cur_epoch in range(self.FLAGS.epochs):
-            batches, num_batches = get_batches(train_data, self.FLAGS.batch_size)
+            if self.train_input is None:
+                batches = batch_indices(num_data, self.FLAGS.batch_size)
+                num_batches = count_batches(num_data, self.FLAGS.batch_size)
+                prefetcher = BatchPrefetcher(batches, prepare, num_workers=prefetch_workers, depth=self.FLAGS.prefetch_depth)
+            else:
+                # The graph reads its own batches (see tf_input.TrainInput)
+                num_batches = self.train_input.num_batches
+                prefetcher = BatchPrefetcher(range(num_batches), lambda _: (None, None), num_workers=0)
             
             # Training loop
-            for _i, batch in enumerate(batches):
+            for _i, (X_batch, y_batch) in enumerate(prefetcher):
                 i = _i + 1  # For convienince
 
                 self.current_lr = lrHelper.get_lr(step)
 
                 #Optimatize using batch
-                loss, norm, step = self.optimize(session, batch)
+                loss, norm, step = self.train_step(session, X_batch, y_batch)
                 losses[step % rolling_ave_window] = loss
                 mean_loss = np.mean(losses)
 
@@ -304,12 +495,15 @@ class Model(object):
                     logging.info("\nSnapshot saved at:  %s \n" % (save_path))
 
             sys.stdout.write('\n')
+            prefetcher.close()
+            if self.train_input is None:
+                logging.info(prefetcher.summary())
 
             # Evaluate accuracy
-            eval_size = min(len(val_data), len(train_data))//10
-            train_acc = self.evaluate_model(session, train_data, eval_size)
+            eval_size = min(len(y_val), num_data)//10
+            train_acc = self.evaluate_model(session, X_train, y_train, eval_size)['top1']
             logging.info("Training Accuracy: %f \t\ton %d examples" % (train_acc, eval_size))
-            val_acc = self.evaluate_model(session, val_data, eval_size)
+            val_acc = self.evaluate_model(session, X_val, y_val, eval_size)['top1']
             logging.info("Validation Accuracy: %f \ton %d examples" % (val_acc, eval_size))
 
             # Save best model based on accuracy (Early Stopping)
@@ -324,3 +518,56 @@ class Model(object):
 
 
                 
+
+
+class EnsembleModel(InferenceModel):
+    def __init__(self, classifiers, FLAGS, *args, normalization=None):
+        """
+        Several snapshots of a classifier in one graph, for inference only. Every
+        member gets its own copy of the variables under the scope member<i>, all of
+        them read the same X, and y_out is the weighted average of their softmax
+        outputs, so one session.run scores a batch with the whole ensemble and the
+        members can run in parallel.
+        :param classifiers: one classifier object per member (see ti_classifiers.get_classifier)
+        :param normalization: see Model
+        """
+        self.FLAGS = FLAGS
+        self.normalization = normalization
+        self.num_members = len(classifiers)
+
+        self.X = tf.placeholder(tf.float32, [None, FLAGS.img_H, FLAGS.img_W, FLAGS.img_C], name="X")
+        self.is_training = tf.placeholder(tf.bool, name="is_training")
+
+        # Same variable names as in Model below the member scope, so checkpoints map over directly
+        member_outputs = []
+        for i, classifier in enumerate(classifiers):
+            with tf.variable_scope("member%d" % i):
+                with tf.variable_scope("model"):
+                    with vs.variable_scope("classify"):
+                        raw_scores = classifier.forward_pass(self.X, self.is_training)
+                        member_outputs.append(tf.nn.softmax(raw_scores, name = "softmax"))
+        self.member_y_out = tf.stack(member_outputs, name = "member_softmax")
+
+        with tf.variable_scope("ensemble"):
+            self.member_weights = tf.Variable(np.full(self.num_members, 1.0 / self.num_members, dtype=np.float32),
+                                              trainable = False, name = "member_weights")
+            self.new_weights = tf.placeholder(tf.float32, [self.num_members], name = "new_weights")
+            self.set_weights_op = tf.assign(self.member_weights, self.new_weights)
+            self.y_out = tf.tensordot(self.member_weights, self.member_y_out, axes = 1, name = "softmax")
+
+
+    def restore(self, session, checkpoints, weights=None):
+        """
+        Load member i from checkpoints[i], a checkpoint written by Model, and set the
+        member weights (default: equal)
+        """
+        assert(len(checkpoints) == self.num_members)
+        for i, checkpoint in enumerate(checkpoints):
+            scope = "member%d/" % i
+            var_list = {v.op.name[len(scope):]: v for v in tf.global_variables() if v.op.name.startswith(scope)}
+            logging.info("Reading member %d parameters from %s" % (i, checkpoint))
+            tf.train.Saver(var_list).restore(session, checkpoint)
+
+        if weights is None:
+            weights = np.full(self.num_members, 1.0 / self.num_members)
+        session.run(self.set_weights_op, {self.new_weights: weights})
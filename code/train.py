@@ -4,6 +4,7 @@ import json
 import tensorflow as tf
 
 from ti_model import Model
+from tf_input import TrainInput
 from ti_classifiers import get_classifier
 from utils import *
 from data_utils import *
@@ -39,7 +40,16 @@ tf.app.flags.DEFINE_bool("background", False, "Prettier logging if running in ba
 tf.app.flags.DEFINE_bool("debug", False, "Run on a small set of data for debugging.")
 tf.app.flags.DEFINE_bool("cifar", False, "Cifar Debug")
 tf.app.flags.DEFINE_bool("augment", True, "Whether or not to expand dataset using data augmentation")
+tf.app.flags.DEFINE_bool("expand", False, "Expand the training set 4x with rotated and flipped copies, generated lazily per batch")
+tf.app.flags.DEFINE_float("jitter_brightness", 0.0, "Max per-image brightness offset for augmentation, in normalized pixel units (0: off)")
+tf.app.flags.DEFINE_float("jitter_contrast", 0.0, "Max per-image relative contrast change for augmentation, e.g. 0.2 (0: off)")
 tf.app.flags.DEFINE_integer("n_classes", 200, "The number of classes. Don't change.")
+tf.app.flags.DEFINE_string("input_mode", "feed", "How training batches reach the model: feed (feed_dict), memory (tf.data over the loaded arrays) or packed (tf.data reading the packed cache from disk; implies --lazy_normalize).")
+tf.app.flags.DEFINE_integer("prefetch_workers", 2, "Threads preparing augmented training batches ahead of the training step (0: prepare inline).")
+tf.app.flags.DEFINE_integer("prefetch_depth", 4, "Max number of prepared training batches waiting in the queue.")
+tf.app.flags.DEFINE_integer("num_workers", 0, "Processes decoding JPEGs when there is no packed dataset (0: one per core).")
+tf.app.flags.DEFINE_bool("lazy_normalize", False, "Keep images as uint8 and subtract the mean image per batch (4x less memory).")
+tf.app.flags.DEFINE_bool("per_channel_norm", False, "Normalize with the per-channel mean and std instead of the mean image.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -61,15 +71,27 @@ def main(_):
     """
     print(vars(FLAGS))
 
+    # The packed input pipeline reads and normalizes the training images itself, so the loaded
+    # splits stay uint8 memory maps (only the packed statistics are read) and the evaluation
+    # batches are normalized on the fly
+    lazy_normalize = FLAGS.lazy_normalize or FLAGS.input_mode == "packed"
+
     if(FLAGS.cifar):
         print ("Loading Cifar10 Dataset")
         dataset = get_CIFAR10_data(FLAGS.data_dir, subtract_mean=True)
     else:
+        packed_dir = pjoin(FLAGS.data_dir, "packed")
+        if FLAGS.input_mode == "packed" and not is_packed(packed_dir):
+            raise ValueError("No packed dataset in %s, run preprocessing/pack_dataset.py first" % packed_dir)
+
         print ("Loading Tiny-Imagenet Dataset")
-        dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = True, dtype=np.float32, subtract_mean=True, debug=FLAGS.debug)
+        dataset = load_tiny_imagenet(FLAGS.data_dir, is_training = True, dtype=np.uint8 if lazy_normalize else np.float32, subtract_mean=True, debug=FLAGS.debug, num_workers=FLAGS.num_workers, per_channel=FLAGS.per_channel_norm)
         print ("Number of Classes: ", len(dataset["class_names"]))
         FLAGS.n_classes = len(dataset["class_names"])
 
+    if FLAGS.expand:
+        dataset = augment(dataset, lazy=True)
+
     #Store img sizes
     FLAGS.img_C = dataset["X_train"].shape[3]
     if FLAGS.augment:
@@ -85,8 +107,26 @@ def main(_):
     print ("Creating '" + FLAGS.classifier + "'")
     classifier = get_classifier(FLAGS.classifier, FLAGS)
 
+    train_input = None
+    if FLAGS.input_mode != "feed":
+        print ("Creating '" + FLAGS.input_mode + "' tf.data input pipeline")
+        if FLAGS.expand:
+            raise ValueError("--expand only works with --input_mode=feed")
+        if FLAGS.input_mode == "packed":
+            if FLAGS.cifar:
+                raise ValueError("--input_mode=packed only works with the packed tiny-imagenet dataset")
+            # The packed images are raw uint8, so they are always normalized in the graph
+            train_input = TrainInput(FLAGS, dataset["X_train"], dataset["y_train"], packed_dir=packed_dir,
+                                     normalization=dataset["normalization"])
+        elif FLAGS.input_mode == "memory":
+            train_input = TrainInput(FLAGS, dataset["X_train"], dataset["y_train"],
+                                     normalization=dataset.get("normalization") if lazy_normalize else None)
+        else:
+            raise ValueError("Unknown input_mode '%s'" % FLAGS.input_mode)
+
     print ("Creating Model")
-    model = Model(classifier, FLAGS)
+    model = Model(classifier, FLAGS, normalization=dataset.get("normalization") if lazy_normalize else None,
+                  train_input=train_input)
 
     if not os.path.exists(FLAGS.log_dir):
         os.makedirs(FLAGS.log_dir)
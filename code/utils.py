@@ -2,6 +2,7 @@ import os
 import random
 import tensorflow as tf
 import math
+import numpy as np
 from os.path import join as pjoin
 import logging
 
@@ -19,13 +20,23 @@ def initialize_model(session, model, train_dir):
     return model
 
 
-def get_batches(dataset, batch_size):
-    random.shuffle(dataset)
-    num_batches = int(math.ceil(len(dataset)/float(batch_size)))
-    batches = []
-    for i in range(num_batches):
-        start_ind = i*batch_size
-        end_ind = min(len(dataset),i*batch_size+batch_size)
-        batches.append(dataset[start_ind:end_ind])
+def count_batches(num_data, batch_size):
+    return int(math.ceil(num_data/float(batch_size)))
 
-    return batches, num_batches
+
+def batch_indices(num_data, batch_size, shuffle=True):
+    # Generator over the index arrays of one epoch, taken from a single permutation
+    order = np.random.permutation(num_data) if shuffle else np.arange(num_data)
+    for start_ind in range(0, num_data, batch_size):
+        yield order[start_ind:start_ind+batch_size]
+
+
+def gather(X, idx, out=None):
+    # X[idx], written into out[:len(idx)] when a buffer is given. Anything that
+    # is not an ndarray (a memmap is one) only needs to support X[idx], e.g.
+    # data_utils.AugmentedImages or shards.ShardReader
+    if not isinstance(X, np.ndarray):
+        return X[idx]
+    if out is None:
+        return X.take(idx, axis=0)
+    return X.take(idx, axis=0, out=out[:len(idx)])